@@ -0,0 +1,693 @@
+import itertools
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from DCTProfile import profiler
+
+###----------------------------------------------
+#
+# Name:     DCTAstrometry
+#
+# Purpose:  This module finds the astrometric
+#           solution (WCS) of an image offline,
+#           against a reference catalog stored on
+#           disk. The RA/Dec and plate scale in
+#           the header are used as priors, stars
+#           in the image are matched to the catalog
+#           by hashing the shapes of triangles of
+#           bright stars, and the match is refined
+#           with a least squares fit.
+#
+#           Example:
+#               catalog = ReferenceCatalog('gaia_field.csv')
+#               solver  = PlateSolver(catalog)
+#               wcs     = solver.solve(image)
+#
+###----------------------------------------------
+
+
+### Coordinate Methods ###
+
+def parseAngle(value, hours = False):
+    """
+    Name: parseAngle
+
+    Description:
+    Converts a sexagesimal string, e.g. '10:04:12.3' or '+20:00:05.1',
+    into decimal degrees. Numbers are returned as they are.
+
+    Parameters:
+    value    The angle as a string or number.
+    hours    Boolean indicating whether the string is in hours, as the
+             right ascension is. Defaults to false.
+    """
+    if (not isinstance(value, str)):
+        return float(value)
+
+    parts = value.strip().replace(' ', ':').split(':')
+    sign = -1.0 if parts[0].startswith('-') else 1.0
+    angle = 0.0
+    for n, part in enumerate(parts):
+        angle += abs(float(part)) / 60**n
+
+    return sign*angle*(15.0 if hours else 1.0)
+
+def project(ra, dec, ra0, dec0):
+    """
+    Name: project
+
+    Description:
+    Gnomonic (TAN) projection of sky positions onto the plane tangent
+    to the sky at (ra0, dec0). All angles are in degrees.
+
+    Returns:
+    The standard coordinates xi (east) and eta (north), in degrees.
+    """
+    ra, dec, ra0, dec0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(ra - ra0)
+    xi   = np.cos(dec)*np.sin(ra - ra0) / cosc
+    eta  = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(ra - ra0)) / cosc
+
+    return np.degrees(xi), np.degrees(eta)
+
+def deproject(xi, eta, ra0, dec0):
+    """
+    Name: deproject
+
+    Description:
+    The inverse of project, converting standard coordinates back into
+    sky positions. All angles are in degrees.
+
+    Returns:
+    The right ascension and declination, in degrees.
+    """
+    xi, eta, ra0, dec0 = np.radians(xi), np.radians(eta), np.radians(ra0), np.radians(dec0)
+    denominator = np.cos(dec0) - eta*np.sin(dec0)
+    ra  = ra0 + np.arctan2(xi, denominator)
+    dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denominator))
+
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+def separation(ra, dec, ra0, dec0):
+    """
+    Name: separation
+
+    Description:
+    The angular distance, in degrees, between sky positions.
+    """
+    ra, dec, ra0, dec0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    haversine = np.sin((dec - dec0)/2)**2 + np.cos(dec)*np.cos(dec0)*np.sin((ra - ra0)/2)**2
+
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(haversine, 0, 1))))
+
+
+### Detection Methods ###
+
+def findStars(image, numbStars = 30, threshold = 5.0, box = 5):
+    """
+    Name: findStars
+
+    Description:
+    Finds the brightest stars in an image. Pixels more than threshold
+    standard deviations above the background which are also the peak of
+    their 3x3 neighborhood are taken as stars. Each star is measured in
+    a box around its peak, and peaks closer than a box width to a
+    brighter star are dropped. Everything is vectorized over the peaks.
+
+    Parameters:
+    image        A 2D numpy array.
+    numbStars    The number of stars to return, brightest first.
+    threshold    The detection threshold, in standard deviations of the
+                 background. Defaults to 5.
+    box          The width, in pixels, of the box used for the centroid
+                 and flux, which should be odd. Defaults to 5.
+
+    Returns:
+    Three numpy arrays of the x (column) and y (row) centroids and the
+    background subtracted fluxes of the stars.
+    """
+    image = np.asarray(image, dtype = np.float64)
+    half = box//2
+
+    #A robust background level and noise from a subsample of the image
+    sample = image[::4, ::4]
+    background = np.median(sample)
+    sigma = 1.4826*np.median(np.abs(sample - background))
+
+    #Peaks above the threshold, away from the edges
+    core = image[1:-1, 1:-1]
+    peak = core > background + threshold*sigma
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if (dy != 0 or dx != 0):
+                peak &= core >= image[1+dy:image.shape[0]-1+dy, 1+dx:image.shape[1]-1+dx]
+    rows, cols = np.nonzero(peak)
+    rows += 1
+    cols += 1
+    inside = (rows >= half) & (rows < image.shape[0] - half) & (cols >= half) & (cols < image.shape[1] - half)
+    rows, cols = rows[inside], cols[inside]
+
+    #Keep a limited number of the brightest peaks, then measure them all at once
+    order = np.argsort(image[rows, cols])[::-1][:20*numbStars]
+    rows, cols = rows[order], cols[order]
+    offsets = np.arange(-half, half + 1)
+    windows = image[rows[:, None, None] + offsets[None, :, None], cols[:, None, None] + offsets[None, None, :]] - background
+    flux = windows.sum(axis = (1,2))
+    weight = np.clip(windows, 0, None)
+    total = weight.sum(axis = (1,2))
+    x = cols + (weight*offsets[None, None, :]).sum(axis = (1,2)) / total
+    y = rows + (weight*offsets[None, :, None]).sum(axis = (1,2)) / total
+
+    #Drop any peak too close to a brighter one, e.g. a second peak on a saturated star
+    order = np.argsort(flux)[::-1]
+    x, y, flux = x[order], y[order], flux[order]
+    keep = []
+    for n in range(len(x)):
+        if (len(keep) == numbStars):
+            break
+        if (len(keep) == 0 or np.min(np.hypot(x[keep] - x[n], y[keep] - y[n])) > box):
+            keep.append(n)
+
+    return x[keep], y[keep], flux[keep]
+
+
+### Matching Methods ###
+
+def triangles(x, y):
+    """
+    Name: triangles
+
+    Description:
+    Forms every triangle from a set of points and describes each one by
+    two numbers which do not change when the triangle is shifted,
+    rotated, scaled or mirrored: the ratios of its middle and shortest
+    sides to its longest side.
+
+    Parameters:
+    x, y    Numpy arrays of the positions of the points.
+
+    Returns:
+    An array of the vertex indices of each triangle, shaped (n, 3) and
+    ordered as the vertices opposite the longest, middle and shortest
+    sides, an array of the two invariants of each triangle, shaped
+    (n, 2), and an array of the length of the longest side of each.
+    """
+    vertices = np.array(list(itertools.combinations(range(len(x)), 3)), dtype = int).reshape(-1, 3)
+    px, py = x[vertices], y[vertices]
+
+    #The side opposite each vertex
+    sides = np.stack([np.hypot(px[:, 1] - px[:, 2], py[:, 1] - py[:, 2]),
+                      np.hypot(px[:, 2] - px[:, 0], py[:, 2] - py[:, 0]),
+                      np.hypot(px[:, 0] - px[:, 1], py[:, 0] - py[:, 1])], axis = 1)
+    order = np.argsort(sides, axis = 1)[:, ::-1]
+    sides = np.take_along_axis(sides, order, axis = 1)
+    vertices = np.take_along_axis(vertices, order, axis = 1)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        invariants = sides[:, 1:] / sides[:, :1]
+
+    return vertices, invariants, sides[:, 0]
+
+def fitAffine(source, target):
+    """
+    Name: fitAffine
+
+    Description:
+    Least squares fit of the affine transform taking the source points to
+    the target points.
+
+    Parameters:
+    source, target    Numpy arrays of points, shaped (n, 2), with n >= 3.
+
+    Returns:
+    A numpy array, shaped (3, 2), such that target = [x, y, 1] @ result.
+    """
+    design = np.column_stack([source, np.ones(len(source))])
+
+    return np.linalg.lstsq(design, target, rcond = None)[0]
+
+def applyAffine(transform, points):
+    return np.column_stack([points, np.ones(len(points))]) @ transform
+
+
+###----------------------------------------------
+#
+# Name:     ReferenceCatalog
+#
+# Purpose:  This class holds a reference star
+#           catalog, read from a CSV or fits table
+#           file with ra, dec (in degrees) and mag
+#           columns, along with a spatial index so
+#           that the stars in a field can be found
+#           without searching the whole catalog.
+#           The sky is split into declination zones
+#           and within each zone the stars are
+#           sorted by right ascension, so a cone
+#           search is a binary search per zone.
+#           The index is saved next to the catalog
+#           the first time it is built.
+#
+###----------------------------------------------
+
+class ReferenceCatalog(object):
+
+    ### Constructor ###
+
+    def __init__(self, path, zoneHeight = 0.5):
+        """
+        Loads the catalog and its index, building and saving the index if
+        it does not exist or is older than the catalog. If the index cannot
+        be saved, e.g. to a read only directory, it is rebuilt every time.
+
+        Parameters:
+        path          The path of the catalog file. Files ending in .fits or
+                      .fit are read as fits tables, anything else as CSV
+                      with a header line.
+        zoneHeight    The height, in degrees, of the declination zones.
+                      Defaults to 0.5.
+
+        Properties:
+        dec           A numpy array of the declination of every star.
+        indexPath     The path the index is saved to.
+        mag           A numpy array of the magnitude of every star.
+        ra            A numpy array of the right ascension of every star.
+        """
+        self._indexPath = os.path.splitext(path)[0] + '.idx.npz'
+        if (os.path.exists(self._indexPath) and os.path.getmtime(self._indexPath) >= os.path.getmtime(path)):
+            with np.load(self._indexPath) as index:
+                if (float(index['zoneHeight']) == zoneHeight):
+                    self._ra, self._dec, self._mag = index['ra'], index['dec'], index['mag']
+                    self._zoneHeight = zoneHeight
+                    self._zoneStart = index['zoneStart']
+                    return
+
+        ra, dec, mag = self.__read(path)
+        self.__buildIndex(ra, dec, mag, zoneHeight)
+        try:
+            np.savez(self._indexPath, ra = self._ra, dec = self._dec, mag = self._mag,
+                     zoneHeight = zoneHeight, zoneStart = self._zoneStart)
+        except OSError:
+            #E.g., a read only catalog directory, so the index is only kept in memory
+            pass
+
+    ### Utility Methods ###
+
+    def __read(self, path):
+        """
+        Name: __read
+
+        Description:
+        Internal "private" method which reads the ra, dec and mag columns
+        of the catalog file. Column names are not case sensitive.
+        """
+        if (path.lower().endswith(('.fits', '.fit'))):
+            table = fits.getdata(path, 1)
+            names = table.names
+        else:
+            table = np.genfromtxt(path, delimiter = ',', names = True)
+            names = table.dtype.names
+        columns = {name.lower(): name for name in names}
+        missing = [name for name in ('ra', 'dec', 'mag') if name not in columns]
+        if (len(missing) > 0):
+            raise(ValueError('The catalog "' + path + '" has no ' + ', '.join(missing) + ' column'))
+
+        return [np.asarray(table[columns[name]], dtype = np.float64) for name in ('ra', 'dec', 'mag')]
+
+    def __buildIndex(self, ra, dec, mag, zoneHeight):
+        """
+        Name: __buildIndex
+
+        Description:
+        Internal "private" method which sorts the stars by zone and right
+        ascension and finds where each zone starts.
+        """
+        numbZones = int(np.ceil(180.0/zoneHeight))
+        zone = self.__zone(dec, zoneHeight)
+        order = np.lexsort((ra, zone))
+
+        self._ra, self._dec, self._mag = ra[order] % 360.0, dec[order], mag[order]
+        self._zoneHeight = zoneHeight
+        self._zoneStart = np.searchsorted(zone[order], np.arange(numbZones + 1))
+
+    @staticmethod
+    def __zone(dec, zoneHeight):
+        numbZones = int(np.ceil(180.0/zoneHeight))
+        return np.clip(np.floor((np.asarray(dec) + 90.0)/zoneHeight).astype(int), 0, numbZones - 1)
+
+    def query(self, ra, dec, radius):
+        """
+        Name: query
+
+        Description:
+        Finds all the stars within a radius of a position.
+
+        Parameters:
+        ra, dec    The center of the search, in degrees.
+        radius     The radius of the search, in degrees.
+
+        Returns:
+        A numpy array of the indices of the stars found, for use with the
+        ra, dec and mag properties.
+        """
+        first = self.__zone(max(dec - radius, -90.0), self._zoneHeight)
+        last  = self.__zone(min(dec + radius, 90.0), self._zoneHeight)
+        if (abs(dec) + radius >= 89.9):
+            width = 180.0
+        else:
+            width = radius / np.cos(np.radians(abs(dec) + radius))
+
+        found = []
+        for zone in range(first, last + 1):
+            start, stop = self._zoneStart[zone], self._zoneStart[zone + 1]
+            zoneRA = self._ra[start:stop]
+            if (width >= 180.0):
+                ranges = [(0.0, 360.0)]
+            else:
+                low, high = (ra - width) % 360.0, (ra + width) % 360.0
+                ranges = [(low, high)] if low <= high else [(low, 360.0), (0.0, high)]
+            for low, high in ranges:
+                found.append(np.arange(start + np.searchsorted(zoneRA, low, 'left'),
+                                       start + np.searchsorted(zoneRA, high, 'right')))
+
+        found = np.concatenate(found) if len(found) > 0 else np.array([], dtype = int)
+
+        return found[separation(self._ra[found], self._dec[found], ra, dec) <= radius]
+
+    ### Magic Methods ###
+
+    def __len__(self):
+        return len(self._ra)
+
+    ### Property Methods ###
+
+    @property
+    def dec(self):
+        return self._dec
+
+    @property
+    def indexPath(self):
+        return self._indexPath
+
+    @property
+    def mag(self):
+        return self._mag
+
+    @property
+    def ra(self):
+        return self._ra
+
+
+###----------------------------------------------
+#
+# Name:     PlateSolver
+#
+# Purpose:  This class finds the WCS of images
+#           using a ReferenceCatalog. The header
+#           pointing and plate scale of an image
+#           are used to project the nearby catalog
+#           stars into pixels, then triangles of
+#           the brightest image and catalog stars
+#           are matched by shape. The best match is
+#           the one under which the most stars line
+#           up, and is refined with a fit to all of
+#           them. Solutions are cached by pointing,
+#           so the next frame of a sequence is first
+#           tried against the previous solution,
+#           skipping the triangle matching.
+#
+###----------------------------------------------
+
+class PlateSolver(object):
+
+    ### Constructor ###
+
+    def __init__(self, catalog, numbStars = 20, tolerance = 2.0, scaleTolerance = 0.1,
+                 searchRadius = 0.1, minMatches = 6):
+        """
+        Sets up the solver.
+
+        Parameters:
+        catalog           The ReferenceCatalog to solve against.
+        numbStars         The number of image stars used for matching, with
+                          twice as many catalog stars in each part of the
+                          search area tried. Defaults to 20.
+        tolerance         The distance, in pixels, within which an image star
+                          and a catalog star are taken to match. Defaults to 2.
+        scaleTolerance    The fractional error allowed in the header plate
+                          scale. Defaults to 0.1.
+        searchRadius      The error, in degrees, allowed in the header pointing.
+                          If this is large compared with the image, the search
+                          area is tried in image sized parts, nearest the
+                          pointing first. Defaults to 0.1.
+        minMatches        The fewest matched stars for a solution to be
+                          accepted. Defaults to 6.
+
+        Properties:
+        cache        The dict of cached solutions, keyed by pointing.
+        matches      The number of stars matched in the last solution.
+        residual     The rms residual, in arcsec, of the last solution.
+        """
+        self._catalog = catalog
+        self._numbStars = numbStars
+        self._tolerance = tolerance
+        self._scaleTolerance = scaleTolerance
+        self._searchRadius = searchRadius
+        self._minMatches = minMatches
+        self._cache = {}
+        self._matches = 0
+        self._residual = None
+
+    ### Utility Methods ###
+
+    def solve(self, image, stars = None):
+        """
+        Name: solve
+
+        Description:
+        Finds the WCS of the image.
+
+        Parameters:
+        image    An instance of DataEnc, usually an Image, whose header gives
+                 the pointing (TELRA, TELDEC) and plate scale (SCALE).
+        stars    Optionally the x, y and flux arrays of the stars in the
+                 image, as returned by findStars. Found if not given.
+
+        Returns:
+        An astropy WCS object.
+        """
+        with profiler.stage('plateSolve'):
+            ra0 = parseAngle(image.ra, hours = True)
+            dec0 = parseAngle(image.dec)
+            scale = float(image.plateScale) / 3600.0
+            height, width = image.image.shape
+
+            if (stars is None):
+                with profiler.stage('findStars'):
+                    stars = findStars(image.image, self._numbStars)
+            x, y, flux = stars
+            if (len(x) < 3):
+                raise(ValueError('Too few stars were found in ' + image.name[0] + ' to solve it'))
+            pixels = np.column_stack([x, y])
+
+            #Try the cached solution of this pointing first
+            key = (round(ra0*60), round(dec0*60), width, height)
+            if (key in self._cache):
+                wcs = self.__refine(pixels, self._cache[key])
+                if (wcs is not None):
+                    profiler.count('plateSolveCacheHits')
+                    return wcs
+            profiler.count('plateSolveCacheMisses')
+
+            #The catalog stars around the pointing, brightest first, projected
+            #into pixels from the center of the image using the plate scale
+            halfDiagonal = 0.5*np.hypot(width, height)
+            found = self._catalog.query(ra0, dec0, halfDiagonal*scale + self._searchRadius)
+            found = found[np.argsort(self._catalog.mag[found])]
+            if (len(found) < 3):
+                raise(ValueError('Too few catalog stars near the pointing of ' + image.name[0]))
+            xi, eta = project(self._catalog.ra[found], self._catalog.dec[found], ra0, dec0)
+            reference = np.column_stack([xi, eta]) / scale
+
+            #Only the brightest catalog stars in an image sized circle are
+            #matched at once, as most of the stars in a larger circle would
+            #not be in the image. The circle is moved around the search area
+            #until the stars match.
+            transform = None
+            with profiler.stage('matchTriangles'):
+                for offset in self.__searchOffsets(halfDiagonal, self._searchRadius/scale):
+                    inside = np.hypot(reference[:, 0] - offset[0], reference[:, 1] - offset[1]) < halfDiagonal
+                    window = reference[inside][:2*self._numbStars]
+                    profiler.count('plateSolveWindows')
+                    if (len(window) >= 3):
+                        transform = self.__matchTriangles(pixels, window)
+                        if (transform is not None):
+                            break
+            if (transform is None):
+                raise(ValueError('Could not match the stars in ' + image.name[0] + ' to the catalog'))
+
+            #Turn the pixel transform into a first guess at the WCS, then refine it
+            center = np.array([(width - 1)/2.0, (height - 1)/2.0])
+            cd = transform[:2].T * scale
+            xiCenter, etaCenter = applyAffine(transform, center[None, :])[0] * scale
+            raCenter, decCenter = deproject(xiCenter, etaCenter, ra0, dec0)
+            wcs = self.__refine(pixels, self.__makeWCS(center, raCenter, decCenter, cd))
+            if (wcs is None):
+                raise(ValueError('Could not refine the solution of ' + image.name[0]))
+
+            self._cache[key] = wcs
+
+            return wcs
+
+    def __matchTriangles(self, pixels, reference):
+        """
+        Name: __matchTriangles
+
+        Description:
+        Internal "private" method which matches triangles of image stars
+        to triangles of catalog stars with the same shape and a size
+        allowed by the plate scale. Each matched pair of triangles gives
+        an affine transform, which is scored by how many image stars land
+        on a catalog star.
+
+        Returns:
+        The best affine transform from pixels to reference, or None.
+        """
+        imageVertices, imageShapes, imageSizes = triangles(pixels[:, 0], pixels[:, 1])
+        refVertices, refShapes, refSizes = triangles(reference[:, 0], reference[:, 1])
+
+        #Skinny triangles are poorly measured, so leave them out
+        good = imageShapes[:, 1] > 0.1
+        imageVertices, imageShapes, imageSizes = imageVertices[good], imageShapes[good], imageSizes[good]
+        good = refShapes[:, 1] > 0.1
+        refVertices, refShapes, refSizes = refVertices[good], refShapes[good], refSizes[good]
+
+        #Pair every image triangle with the catalog triangles of the same
+        #shape and a size allowed by the plate scale. The catalog triangles
+        #are sorted by their first invariant, so each image triangle pairs
+        #with a contiguous run of them.
+        order = np.argsort(refShapes[:, 0])
+        refVertices, refShapes, refSizes = refVertices[order], refShapes[order], refSizes[order]
+        epsilon = 0.01
+        low  = np.searchsorted(refShapes[:, 0], imageShapes[:, 0] - epsilon, 'left')
+        high = np.searchsorted(refShapes[:, 0], imageShapes[:, 0] + epsilon, 'right')
+        counts = high - low
+        imageIndex = np.repeat(np.arange(len(imageVertices)), counts)
+        refIndex = np.arange(np.sum(counts)) + np.repeat(low - np.cumsum(counts) + counts, counts)
+        keep = ((np.abs(refShapes[refIndex, 1] - imageShapes[imageIndex, 1]) < epsilon) &
+                (np.abs(refSizes[refIndex]/imageSizes[imageIndex] - 1) < self._scaleTolerance))
+        imageIndex, refIndex = imageIndex[keep], refIndex[keep]
+        if (len(imageIndex) == 0):
+            return None
+
+        #Each pair votes for the three star matches it implies. The true
+        #matches are voted for by many pairs, chance ones by few, so the
+        #pairs made of the most voted for matches are the likeliest.
+        imageStars, refStars = imageVertices[imageIndex], refVertices[refIndex]
+        votes = np.bincount((imageStars*len(reference) + refStars).ravel(), minlength = len(pixels)*len(reference))
+        score = np.sum(votes.reshape(len(pixels), len(reference))[imageStars, refStars], axis = 1)
+
+        #Only the best few pairs are fitted and scored
+        best, bestCount = None, self._minMatches - 1
+        for n in np.argsort(score, kind = 'stable')[::-1][:10]:
+            transform = fitAffine(pixels[imageStars[n]], reference[refStars[n]])
+            count = np.sum(self.__nearest(applyAffine(transform, pixels), reference) < self._tolerance)
+            if (count > bestCount):
+                best, bestCount = transform, count
+
+        return best
+
+    def __refine(self, pixels, wcs):
+        """
+        Name: __refine
+
+        Description:
+        Internal "private" method which matches the image stars to the
+        catalog stars using the given WCS and fits a new WCS to all the
+        matches, keeping the tangent point at the center of the image.
+
+        Returns:
+        The refined WCS, or None if too few stars matched.
+        """
+        center = wcs.wcs.crpix - 1
+        cd = wcs.wcs.cd.copy()
+        raCenter, decCenter = wcs.wcs.crval
+        scale = np.sqrt(abs(np.linalg.det(cd)))
+        height, width = 2*center[1] + 1, 2*center[0] + 1
+        radius = 0.5*np.hypot(width, height)*scale*1.1
+        found = self._catalog.query(raCenter, decCenter, radius)
+        if (len(found) < self._minMatches):
+            return None
+
+        for iteration in range(3):
+            xi, eta = project(self._catalog.ra[found], self._catalog.dec[found], raCenter, decCenter)
+            reference = np.column_stack([xi, eta])
+            predicted = (pixels - center) @ cd.T
+            distance, nearest = self.__nearest(predicted/scale, reference/scale, index = True)
+            matched = distance < self._tolerance
+            if (np.sum(matched) < self._minMatches):
+                return None
+
+            #Fit sky offset = CD (pixel - center) + shift, then move the tangent point by the shift
+            transform = fitAffine(pixels[matched] - center, reference[nearest[matched]])
+            cd = transform[:2].T
+            raCenter, decCenter = deproject(transform[2, 0], transform[2, 1], raCenter, decCenter)
+
+        residual = reference[nearest[matched]] - applyAffine(transform, pixels[matched] - center)
+        self._matches = int(np.sum(matched))
+        self._residual = float(np.sqrt(np.mean(np.sum(residual**2, axis = 1)))*3600)
+
+        return self.__makeWCS(center, raCenter, decCenter, cd)
+
+    @staticmethod
+    def __searchOffsets(halfDiagonal, searchRadius):
+        """
+        Name: __searchOffsets
+
+        Description:
+        Internal "private" method which returns the centers, in pixels from
+        the pointing, of the image sized circles which cover the search
+        area. They lie on a grid spaced by half the radius of a circle and
+        are sorted by distance from the pointing, which comes first.
+        """
+        spacing = 0.5*halfDiagonal
+        steps = int(searchRadius // spacing)
+        grid = spacing*np.arange(-steps, steps + 1)
+        offsets = np.array([(x, y) for x in grid for y in grid if np.hypot(x, y) <= searchRadius + 1e-9*spacing])
+
+        return offsets[np.argsort(np.hypot(offsets[:, 0], offsets[:, 1]), kind = 'stable')]
+
+    @staticmethod
+    def __nearest(points, reference, index = False):
+        distance = np.hypot(points[:, None, 0] - reference[None, :, 0], points[:, None, 1] - reference[None, :, 1])
+        nearest = np.argmin(distance, axis = 1)
+        closest = distance[np.arange(len(points)), nearest]
+
+        return (closest, nearest) if index else closest
+
+    @staticmethod
+    def __makeWCS(center, ra, dec, cd):
+        wcs = WCS(naxis = 2)
+        wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        wcs.wcs.crpix = center + 1
+        wcs.wcs.crval = [float(ra), float(dec)]
+        wcs.wcs.cd = cd
+
+        return wcs
+
+    def clearCache(self):
+        self._cache = {}
+
+    ### Property Methods ###
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def matches(self):
+        return self._matches
+
+    @property
+    def residual(self):
+        return self._residual
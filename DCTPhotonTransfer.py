@@ -0,0 +1,293 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+###----------------------------------------------
+#
+# Name:     PhotonTransfer
+#
+# Purpose:  This class measures the gain and read
+#           noise of the detector from pairs of
+#           Bias and Flat images. Every pair is
+#           differenced and the variance of the
+#           difference is found over a grid of
+#           square tiles of the detector in a
+#           single vectorized pass. A photon
+#           transfer curve (variance against
+#           signal) is then fit in every tile at
+#           once and the results are summarized
+#           for each amplifier.
+#
+###----------------------------------------------
+
+class PhotonTransfer(object):
+
+    ### Constructor ###
+
+    def __init__(self, biasPairs, flatPairs, tileSize = 64, amplifiers = None, maxSignal = None):
+        """
+        Measures the gain and read noise from pairs of images.
+
+        The variance of the difference of two frames taken under the same
+        conditions removes the fixed pattern (flat field) structure, leaving
+        twice the shot and read noise variance. For each tile and each flat
+        pair the mean signal and half the difference variance are found, and
+        a line, variance = signal / gain + readNoise**2, is fit through all
+        the flat pairs. The read noise itself is measured from the bias pairs.
+
+        Parameters:
+        biasPairs     A list of 2-tuples of Bias instances. At least one
+                      pair is required.
+        flatPairs     A list of 2-tuples of Flat instances. Both frames of a
+                      pair should have the same exposure time. At least two
+                      pairs, at different exposure levels, are required.
+        tileSize      The width and height, in pixels, of the square tiles
+                      the detector is divided into. Defaults to 64.
+        amplifiers    A dict mapping the name of each amplifier to the region
+                      of the image it reads out, given as (x0, x1, y0, y1) in
+                      pixels with exclusive upper bounds. A tile belongs to the
+                      amplifier containing its center. Defaults to the
+                      amplifiers property of the flats. For the gain of each
+                      amplifier to be measured, rather than the header GAIN
+                      they were scaled to, the frames should be loaded with
+                      normalizeGain set to false.
+        maxSignal     Tiles whose mean signal, in ADU, is above this value
+                      are left out of the fit, e.g., to avoid saturation or
+                      nonlinearity. Defaults to no limit.
+
+        Properties:
+        amplifiers      The dict of amplifier regions used.
+        gain            A dict of the median gain, in e-/ADU, of each amplifier.
+        gainMap         A 2D numpy array of the gain in each tile.
+        headerGain      The value of the GAIN keyword in the flats, for comparison.
+        readNoise       A dict of the median read noise, in e-, of each amplifier.
+        readNoiseADU    A dict of the median read noise, in ADU, of each amplifier.
+        readNoiseMap    A 2D numpy array of the read noise, in e-, in each tile.
+        signal          A 3D numpy array of the mean signal in each tile of each
+                        flat pair, indexed as pair, tile row, tile column.
+        tileSize        The size of the tiles, in pixels.
+        variance        A 3D numpy array of the variance in each tile of each
+                        flat pair, shaped like signal.
+        """
+        if (len(biasPairs) == 0):
+            raise(ValueError('At least one pair of bias images is required'))
+        if (len(flatPairs) < 2):
+            raise(ValueError('At least two pairs of flat images are required'))
+
+        self._tileSize = tileSize
+        self._headerGain = flatPairs[0][0].gain
+        if (amplifiers is None):
+            amplifiers = flatPairs[0][0].amplifiers
+        self._amplifiers = amplifiers
+
+        #Find the bias level and read noise of every tile from the bias pairs
+        biasMean, biasVar = np.mean([self.__tileStats(pair) for pair in biasPairs], axis = 0)
+        readNoiseADU = np.sqrt(biasVar)
+
+        #Find the signal and variance of every tile for every flat pair
+        signal   = []
+        variance = []
+        for pair in flatPairs:
+            mean, var = self.__tileStats(pair)
+            if (not pair[0].isBiasCorrected):
+                mean = mean - biasMean
+            signal.append(mean)
+            variance.append(var)
+        self._signal   = np.array(signal)
+        self._variance = np.array(variance)
+
+        #Fit the photon transfer curve in every tile at once with a weighted
+        #linear least squares fit. Points above maxSignal get zero weight.
+        weight = np.ones(self._signal.shape)
+        if (maxSignal is not None):
+            weight[self._signal > maxSignal] = 0.0
+        n   = np.sum(weight, axis = 0)
+        sx  = np.sum(weight*self._signal, axis = 0)
+        sy  = np.sum(weight*self._variance, axis = 0)
+        sxx = np.sum(weight*self._signal**2, axis = 0)
+        sxy = np.sum(weight*self._signal*self._variance, axis = 0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            slope = (n*sxy - sx*sy) / (n*sxx - sx**2)
+            self._gainMap = np.where(slope > 0, 1.0/slope, np.nan)
+        self._readNoiseMap = self._gainMap*readNoiseADU
+
+        #Summarize every amplifier by the median over its tiles
+        self._gain = {}
+        self._readNoise = {}
+        self._readNoiseADU = {}
+        for name, region in self._amplifiers.items():
+            mask = self.__ampMask(region)
+            self._gain[name]         = float(np.nanmedian(self._gainMap[mask]))
+            self._readNoise[name]    = float(np.nanmedian(self._readNoiseMap[mask]))
+            self._readNoiseADU[name] = float(np.nanmedian(readNoiseADU[mask]))
+
+    ### Utility Methods ###
+
+    def __tileStats(self, pair):
+        """
+        Name: __tileStats
+
+        Description:
+        Internal "private" method which finds the mean of a pair of images
+        and half the variance of their difference in every tile. The images
+        are cropped to a whole number of tiles and reshaped so that all the
+        tiles are reduced at once without any python loops.
+
+        Parameters:
+        pair    A 2-tuple of DataEnc instances.
+
+        Returns:
+        Two 2D numpy arrays, the mean and the variance in each tile.
+        """
+        first  = self.__tiles(pair[0].image)
+        second = self.__tiles(pair[1].image)
+        mean = 0.5*(first.mean(axis = (1,3)) + second.mean(axis = (1,3)))
+        var  = 0.5*(first - second).var(axis = (1,3))
+
+        return mean, var
+
+    def __tiles(self, image):
+        """
+        Name: __tiles
+
+        Description:
+        Internal "private" method which returns a view of the image split
+        into tiles, indexed as tile row, row, tile column, column.
+        """
+        t = self._tileSize
+        ny, nx = image.shape[0]//t, image.shape[1]//t
+
+        return np.asarray(image[:ny*t, :nx*t], dtype = np.float64).reshape(ny, t, nx, t)
+
+    def __ampMask(self, region):
+        """
+        Name: __ampMask
+
+        Description:
+        Internal "private" method which returns a boolean array marking
+        the tiles whose centers fall inside the given amplifier region.
+        """
+        x0, x1, y0, y1 = region
+        ny, nx = self._gainMap.shape
+        centerX = (np.arange(nx) + 0.5)*self._tileSize
+        centerY = (np.arange(ny) + 0.5)*self._tileSize
+        inX = (centerX >= x0) & (centerX < x1)
+        inY = (centerY >= y0) & (centerY < y1)
+
+        return np.outer(inY, inX)
+
+    def show(self, amplifier = None):
+        """
+        Plots the photon transfer curve so it can be seen visually. Every
+        tile of every flat pair is plotted along with the fit line for each
+        amplifier.
+
+        Parameters
+        amplifier    The name of the amplifier to plot. Defaults to all of them.
+        """
+        names = list(self._amplifiers) if amplifier is None else [amplifier]
+        for name in names:
+            mask = self.__ampMask(self._amplifiers[name])
+            signal = self._signal[:, mask].ravel()
+            plt.loglog(signal, self._variance[:, mask].ravel(), '.', ms = 2, label = name)
+            level = np.linspace(signal.min(), signal.max(), 100)
+            plt.loglog(level, level/self._gain[name] + self._readNoiseADU[name]**2, '-')
+        plt.xlabel('Signal (ADU)')
+        plt.ylabel('Variance (ADU$^2$)')
+        plt.legend()
+        plt.show(block = False)
+
+    ### Class Methods ###
+
+    @classmethod
+    def fromFrames(cls, biases, flats, **kwargs):
+        """
+        Name: fromFrames
+
+        Description:
+        Builds the pairs needed for the measurement from lists of frames.
+        Consecutive biases are paired together, and flats are grouped by
+        exposure time and paired consecutively within each group. A frame
+        left without a partner is not used.
+
+        This is a class method and thus must be called from the class
+        rather than from a specific instance.
+
+        Parameters:
+        biases      A list of Bias instances.
+        flats       A list of Flat instances.
+        **kwargs    Any other keywords are passed on to the constructor.
+
+        Returns:
+        A new instance of PhotonTransfer.
+        """
+        biasPairs = list(zip(biases[0::2], biases[1::2]))
+
+        levels = {}
+        for flat in flats:
+            levels.setdefault(float(np.sum(flat.expTime)), []).append(flat)
+        flatPairs = []
+        for expTime in sorted(levels):
+            group = levels[expTime]
+            flatPairs += list(zip(group[0::2], group[1::2]))
+
+        return cls(biasPairs, flatPairs, **kwargs)
+
+    ### Magic Methods ###
+
+    def __str__(self):
+        string = 'PHOTON TRANSFER SUMMARY\n' + \
+                 'Header Gain:    ' + str(self.headerGain) + ' e-/ADU\n' + \
+                 'Tile Size:      ' + str(self.tileSize) + ' pix\n' + \
+                 'Flat Pairs:     ' + str(self._signal.shape[0]) + '\n\n'
+        for name in self._amplifiers:
+            string += 'Amplifier ' + name + '\n' + \
+                      'Gain:           ' + '{:.3f}'.format(self._gain[name]) + ' e-/ADU\n' + \
+                      'Read Noise:     ' + '{:.2f}'.format(self._readNoise[name]) + ' e- (' + \
+                      '{:.2f}'.format(self._readNoiseADU[name]) + ' ADU)\n\n'
+
+        return string
+
+    def __repr__(self):
+        return self.__str__()
+
+    ### Property Methods ###
+
+    @property
+    def amplifiers(self):
+        return self._amplifiers
+
+    @property
+    def gain(self):
+        return self._gain
+
+    @property
+    def gainMap(self):
+        return self._gainMap
+
+    @property
+    def headerGain(self):
+        return self._headerGain
+
+    @property
+    def readNoise(self):
+        return self._readNoise
+
+    @property
+    def readNoiseADU(self):
+        return self._readNoiseADU
+
+    @property
+    def readNoiseMap(self):
+        return self._readNoiseMap
+
+    @property
+    def signal(self):
+        return self._signal
+
+    @property
+    def tileSize(self):
+        return self._tileSize
+
+    @property
+    def variance(self):
+        return self._variance
@@ -0,0 +1,307 @@
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+###----------------------------------------------
+#
+# Name:     Profiler
+#
+# Purpose:  This class instruments the reduction
+#           pipeline. Code is split into named
+#           stages with "with profiler.stage(name)"
+#           and every stage records its wall and
+#           CPU time and, optionally, the peak
+#           memory allocated while it ran. Named
+#           counters keep track of things like the
+#           number of frames and bytes read. The
+#           results can be written out as a JSON
+#           trace, viewable in chrome://tracing or
+#           Perfetto, or shown as a summary table.
+#
+#           The profiler is disabled by default,
+#           in which case stage returns a shared,
+#           do nothing context manager so that the
+#           instrumentation costs next to nothing.
+#
+###----------------------------------------------
+
+class Profiler(object):
+
+    ### Constructor ###
+
+    def __init__(self):
+        """
+        Creates a disabled profiler with no recorded stages.
+
+        Properties:
+        counters       A dict of the totals of every counter.
+        enabled        Boolean, whether stages are being recorded.
+        events         A list of every recorded stage, as tuples of the
+                       name, start time, wall time, CPU time (all in
+                       seconds), peak memory (in bytes, or None if memory
+                       is not tracked) and process ID.
+        trackMemory    Boolean, whether peak memory is being tracked.
+        """
+        self._enabled = False
+        self._trackMemory = False
+        self._stack = []
+        self.reset()
+
+    ### Utility Methods ###
+
+    def enable(self, trackMemory = False):
+        """
+        Name: enable
+
+        Description:
+        Starts recording stages and counters.
+
+        Parameters:
+        trackMemory    Boolean determining whether to track the peak memory
+                       allocated in each stage with tracemalloc. This slows
+                       down allocations noticeably so it defaults to false.
+        """
+        self._enabled = True
+        self._trackMemory = trackMemory
+        if (trackMemory and not tracemalloc.is_tracing()):
+            tracemalloc.start()
+
+    def disable(self):
+        """
+        Name: disable
+
+        Description:
+        Stops recording. Anything already recorded is kept.
+        """
+        self._enabled = False
+        if (self._trackMemory and tracemalloc.is_tracing()):
+            tracemalloc.stop()
+        self._trackMemory = False
+
+    def reset(self):
+        """
+        Name: reset
+
+        Description:
+        Throws away all the recorded stages and counters.
+        """
+        self._events = []
+        self._counters = {}
+
+    def stage(self, name):
+        """
+        Name: stage
+
+        Description:
+        Returns a context manager which records the time spent, and
+        optionally the peak memory allocated, inside the with block
+        as a stage with the given name. Stages can be nested.
+
+        Parameters:
+        name    The name of the stage, e.g., 'read' or 'calibrate'.
+        """
+        if (not self._enabled):
+            return _NULL_STAGE
+
+        return _Stage(self, name)
+
+    def count(self, name, value = 1):
+        """
+        Name: count
+
+        Description:
+        Adds the value to the named counter, e.g., count('bytesRead', n).
+        Does nothing if the profiler is disabled.
+        """
+        if (self._enabled):
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def drain(self):
+        """
+        Name: drain
+
+        Description:
+        Returns everything recorded so far and resets the profiler. This
+        is used to send the results of a worker process back to the main
+        process, which adds them to its own with merge.
+
+        Returns:
+        A tuple of the list of events and the dict of counters.
+        """
+        recorded = (self._events, self._counters)
+        self.reset()
+
+        return recorded
+
+    def merge(self, recorded):
+        """
+        Name: merge
+
+        Description:
+        Adds the events and counters returned by drain, usually in
+        another process, to this profiler.
+        """
+        events, counters = recorded
+        self._events += events
+        for name, value in counters.items():
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Name: summary
+
+        Description:
+        Totals the recorded stages by name.
+
+        Returns:
+        A dict keyed by stage name of dicts with the number of calls and
+        the total wall time, total CPU time and largest peak memory.
+        """
+        totals = {}
+        for name, start, wall, cpu, peak, pid in self._events:
+            total = totals.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None})
+            total['calls'] += 1
+            total['wall']  += wall
+            total['cpu']   += cpu
+            if (peak is not None):
+                total['peak'] = peak if total['peak'] is None else max(total['peak'], peak)
+
+        return totals
+
+    def table(self):
+        """
+        Name: table
+
+        Description:
+        Formats the summary and the counters as a text table, with the
+        stages sorted by total wall time.
+
+        Returns:
+        The table as a string.
+        """
+        totals = self.summary()
+        string = '{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}\n'.format('Stage', 'Calls', 'Wall (s)', 'Mean (ms)', 'CPU (s)', 'Peak (MB)')
+        for name in sorted(totals, key = lambda name: -totals[name]['wall']):
+            total = totals[name]
+            peak = '-' if total['peak'] is None else '{:.1f}'.format(total['peak']/2**20)
+            string += '{:<16}{:>8}{:>12.3f}{:>12.2f}{:>12.3f}{:>12}\n'.format(name, total['calls'], total['wall'],
+                                                                            1000*total['wall']/total['calls'],
+                                                                            total['cpu'], peak)
+        if (len(self._counters) > 0):
+            string += '\n{:<16}{:>20}\n'.format('Counter', 'Total')
+            for name in sorted(self._counters):
+                string += '{:<16}{:>20}\n'.format(name, self._counters[name])
+
+        return string
+
+    def writeTrace(self, path):
+        """
+        Name: writeTrace
+
+        Description:
+        Writes the recorded stages to a JSON file in the Chrome trace
+        event format, along with the summary and counters.
+
+        Parameters:
+        path    The path of the JSON file to write.
+        """
+        traceEvents = []
+        for name, start, wall, cpu, peak, pid in self._events:
+            args = {'cpu': cpu}
+            if (peak is not None):
+                args['peak'] = peak
+            traceEvents.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': pid,
+                                'ts': 1e6*start, 'dur': 1e6*wall, 'args': args})
+
+        with open(path, 'w') as traceFile:
+            json.dump({'traceEvents': traceEvents,
+                       'summary': self.summary(),
+                       'counters': self._counters}, traceFile, indent = 1)
+
+    ### Magic Methods ###
+
+    def __str__(self):
+        return self.table()
+
+    def __repr__(self):
+        return self.__str__()
+
+    ### Property Methods ###
+
+    @property
+    def counters(self):
+        return self._counters
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def events(self):
+        return self._events
+
+    @property
+    def trackMemory(self):
+        return self._trackMemory
+
+
+###----------------------------------------------
+#
+# Name:     _Stage
+#
+# Purpose:  The context manager returned by
+#           Profiler.stage while the profiler is
+#           enabled. It records a single event
+#           when the with block exits.
+#
+###----------------------------------------------
+
+class _Stage(object):
+
+    __slots__ = ('profiler', 'name', 'wall', 'cpu', 'current', 'peak')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.current = None
+        if (self.profiler._trackMemory):
+            #Peak memory can only be reset globally, so the peak of a nested
+            #stage is passed up to the enclosing stage when the nested one ends
+            self.current, peak = tracemalloc.get_traced_memory()
+            self.peak = self.current
+            if (len(self.profiler._stack) > 0 and self.profiler._stack[-1].current is not None):
+                parent = self.profiler._stack[-1]
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+        self.profiler._stack.append(self)
+        self.cpu  = time.process_time()
+        self.wall = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu  = time.process_time() - self.cpu
+        self.profiler._stack.pop()
+
+        peak = None
+        if (self.current is not None and tracemalloc.is_tracing()):
+            absolute = max(tracemalloc.get_traced_memory()[1], self.peak)
+            peak = absolute - self.current
+            if (len(self.profiler._stack) > 0 and self.profiler._stack[-1].current is not None):
+                parent = self.profiler._stack[-1]
+                parent.peak = max(parent.peak, absolute)
+
+        self.profiler._events.append((self.name, self.wall, wall, cpu, peak, os.getpid()))
+
+        return False
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+#The profiler shared by the whole pipeline
+profiler = Profiler()
@@ -1,11 +1,17 @@
 import abc
+import concurrent.futures
 import copy
+import fnmatch
 import numpy as np
+import os
 import re
 import sys
+import tempfile
+import weakref
 from astropy.io import fits
 import astropy.visualization as vis
 import matplotlib.pyplot as plt
+from DCTProfile import profiler
 
 ###----------------------------------------------
 #
@@ -25,16 +31,42 @@ import matplotlib.pyplot as plt
 ###----------------------------------------------
 
 class DataEnc(metaclass = abc.ABCMeta):
-    
+
+    #A fixed set of attributes, rather than a __dict__, keeps instances small
+    __slots__ = ('name', '__header', '__prescan', '__image', '__postscan', '__original',
+                 '__amplifiers', '__sharedFile', '__weakref__')
+
+    #The instances of each subclass which currently exist. Weak references
+    #drop out on their own once an instance is deleted, so no destructor
+    #is needed to keep the count right.
+    __instances = {}
+
     ### Constructor ###
+
+    def __new__(cls, *args, **kwargs):
+        #Instances are counted here rather than in __init__ so that copies
+        #and instances unpickled in other processes are counted too
+        self = super().__new__(cls)
+        DataEnc.__instances.setdefault(cls, weakref.WeakSet()).add(self)
+        self.__sharedFile = None
+
+        return self
     
-    def __init__(self, path, subtractOverscans, removeCosmicRays):
+    def __init__(self, path, subtractOverscans, removeCosmicRays, amplifiers = None, keepOriginal = True,
+                 normalizeGain = True):
         """
         Contains all the data from the input fits file.
         
         This constructor reads in a fits file from the DCT
         and separates out certain header information as well
         as the actual image data.
+
+        If the detector was read out through several amplifiers,
+        each amplifier is overscan corrected with its own bias
+        section and, unless normalizeGain is false, scaled to a
+        common gain before the sections are stitched into the
+        image. See getAmplifiers for how the amplifier layout is
+        found.
         
         Keywords:
         subtractOverscans   Boolean determining whether to subtract
@@ -43,9 +75,22 @@ class DataEnc(metaclass = abc.ABCMeta):
         removeCosmicRays    Boolean determining whether to remove
                             anomalously high points which result
                             from cosmic rays. Defaults to true.
+        amplifiers          An optional table describing the amplifier
+                            layout, overriding the header. See
+                            getAmplifiers.
+        keepOriginal        Boolean determining whether to keep the
+                            unscaled image, so that scale can be
+                            called more than once. Defaults to true.
+        normalizeGain       Boolean determining whether to scale each
+                            amplifier to the header GAIN. If false, the
+                            image is left in raw ADU, e.g. to measure
+                            the gain of each amplifier. Defaults to
+                            true.
         
         Properties:
         airmass         The airmass of the observation
+        amplifiers      A dict of the region (x0, x1, y0, y1) of the image
+                        read out by each amplifier.
         date            The UTC date and time of the observation in
                         the format YYYY-MM-DD   HH:MM:SS.SS
         dec             The declination of the observation in the
@@ -79,32 +124,115 @@ class DataEnc(metaclass = abc.ABCMeta):
                 self.name = [path]
             
             #Read in the image
-            fitsData = fits.open(path)
+            with profiler.stage('read'):
+                fitsData = fits.open(path)
+                raw = fitsData[0].data
+            profiler.count('framesRead')
+            profiler.count('bytesRead', raw.nbytes)
             
             #Extract the header and data
             self.__header = [fitsData[0].header]
-            data = np.transpose(fitsData[0].data)
-            
-            #Extract the prescan, image, and overscan
-            self.__prescan     = data[0:self.__header[0]['PRESCAN']]
-            self.__image       = np.transpose(data[self.__header[0]['PRESCAN']:self.__header[0]['NAXIS1']-self.__header[0]['POSTSCAN']])
-            self.__postscan    = data[self.__header[0]['NAXIS1']-self.__header[0]['POSTSCAN']:]
+            amps = getAmplifiers(self.__header[0], amplifiers)
+            if (amps is None):
+                with profiler.stage('slice'):
+                    data = np.transpose(raw)
+                    
+                    #Extract the prescan, image, and overscan
+                    self.__prescan     = data[0:self.__header[0]['PRESCAN']]
+                    self.__image       = np.transpose(data[self.__header[0]['PRESCAN']:self.__header[0]['NAXIS1']-self.__header[0]['POSTSCAN']])
+                    
+                    #Integer data cannot hold the corrections, so work in floating point
+                    self.__image       = self.__image.astype(np.result_type(raw.dtype, np.float32))
+                    self.__postscan    = data[self.__header[0]['NAXIS1']-self.__header[0]['POSTSCAN']:]
+                self.__amplifiers = {'A': (0, self.__image.shape[1], 0, self.__image.shape[0])}
+            else:
+                #Each amplifier is overscan corrected as it is stitched in
+                with profiler.stage('amplifiers'):
+                    self.__readAmplifiers(raw, amps, subtractOverscans, normalizeGain)
+                subtractOverscans = False
             
             #Correct the image
-            self.__correctImage(subtractOverscans, removeCosmicRays)
+            with profiler.stage('correctImage'):
+                self.__correctImage(subtractOverscans, removeCosmicRays)
 
             #Keep an original copy of the image, in case we have to revert back to it
-            self.__original = self.__image
+            self.__original = self.__image if keepOriginal else None
             
         except FileNotFoundError:
-            print('FileNotFoundError: Could not find "'+path+'"')
-            sys.exit()
+            raise(FileNotFoundError('Could not find "'+path+'"'))
         
         except OSError:
-            print('OSError: Incorrect file type')
-            sys.exit()
-    
+            raise(OSError('Incorrect file type "'+path+'"'))
+
     ### Utility Methods ###
+
+    def __readAmplifiers(self, raw, amps, subtractOverscans, normalizeGain = True):
+        """
+        Name: __readAmplifiers
+
+        Description:
+        Internal "private" method which builds the image from the data
+        sections of several amplifiers. The output image is allocated
+        once and every amplifier writes straight into its own part of it
+        from a view of the raw data, so no intermediate copies are made.
+        The amplifiers are processed concurrently on a shared thread
+        pool; numpy releases the GIL while doing the arithmetic.
+
+        Each amplifier has the mean of its own bias section subtracted,
+        if subtractOverscans is set, and, if normalizeGain is set, is
+        multiplied by its gain over the header GAIN (or the gain of the
+        first amplifier) so that the whole image has a single gain.
+
+        The bias sections of the first and last amplifiers are kept as
+        the prescan and postscan.
+
+        Parameters:
+        raw                  The 2D numpy array of the raw fits data.
+        amps                 The list of amplifiers from getAmplifiers.
+        subtractOverscans    Boolean determining whether to subtract the
+                             overscan of each amplifier.
+        normalizeGain        Boolean determining whether to scale each
+                             amplifier to a common gain.
+        """
+        #Place each amplifier by its DETSEC if given, otherwise by its DATASEC,
+        #with the sections shifted so the image starts at the origin
+        placement = [amp['DETSEC'] if amp['DETSEC'] is not None else amp['DATASEC'] for amp in amps]
+        y0 = min(rows.start for rows, cols, flipRows, flipCols in placement)
+        y1 = max(rows.stop for rows, cols, flipRows, flipCols in placement)
+        x0 = min(cols.start for rows, cols, flipRows, flipCols in placement)
+        x1 = max(cols.stop for rows, cols, flipRows, flipCols in placement)
+
+        image = np.empty((y1 - y0, x1 - x0), dtype = np.result_type(raw.dtype, np.float32))
+        if ('GAIN' in self.__header[0]):
+            gain = self.__header[0]['GAIN']
+        else:
+            gain = amps[0]['GAIN']
+
+        def correct(amp, section):
+            rows, cols, flipRows, flipCols = section
+            dataRows, dataCols, dataFlipRows, dataFlipCols = amp['DATASEC']
+            data = raw[dataRows, dataCols]
+            if (flipRows != dataFlipRows):
+                data = data[::-1]
+            if (flipCols != dataFlipCols):
+                data = data[:, ::-1]
+            out = image[rows.start - y0:rows.stop - y0, cols.start - x0:cols.stop - x0]
+            if (data.shape != out.shape):
+                raise(ValueError('The data and detector sections of amplifier ' + amp['name'] + ' have different sizes'))
+
+            level = np.mean(raw[amp['BIASSEC'][0], amp['BIASSEC'][1]]) if subtractOverscans else 0.0
+            np.subtract(data, level, out = out, casting = 'unsafe')
+            if (normalizeGain and amp['GAIN'] != gain):
+                out *= amp['GAIN'] / gain
+
+        list(_getAmplifierPool().map(correct, amps, placement))
+
+        self.__image    = image
+        self.__prescan  = np.transpose(raw[amps[0]['BIASSEC'][0], amps[0]['BIASSEC'][1]])
+        self.__postscan = np.transpose(raw[amps[-1]['BIASSEC'][0], amps[-1]['BIASSEC'][1]])
+        self.__amplifiers = {}
+        for amp, (rows, cols, flipRows, flipCols) in zip(amps, placement):
+            self.__amplifiers[amp['name']] = (cols.start - x0, cols.stop - x0, rows.start - y0, rows.stop - y0)
     
     def __correctImage(self, subtractOverscans, removeCosmicRays):
         """
@@ -120,7 +248,7 @@ class DataEnc(metaclass = abc.ABCMeta):
         removeCosmicRays     This is a boolean indicating whether anomalously
                              high values, i.e., cosmic rays, should be smoothed out
         """
-        if (subtractOverscans):
+        if (subtractOverscans and self.prescan.size + self.postscan.size > 0):
             #Fine the mean of both the pre and post scan regions and subtract that value
             #from each element of the image.
             overscanMean = np.mean(np.concatenate((self.prescan, self.postscan)))
@@ -130,7 +258,196 @@ class DataEnc(metaclass = abc.ABCMeta):
             #This component removes anomalously high values within the image by setting it
             #to the average of the surrounding values instead.
             pass
-    
+
+    def _calibrate(self, correction, operation):
+        """
+        Name: _calibrate
+
+        Description:
+        Internal method used by the calibration methods of the subclasses
+        (subtractBias, subtractDark, divideFlat) to apply a correction to
+        the image. The correction is applied to the unscaled original image,
+        so any previous call to scale will have to be repeated.
+
+        Parameters:
+        correction    A 2D numpy array the same shape as the image, e.g., the
+                      image of a master bias or a scaled master dark.
+        operation     The numpy function used to apply the correction, e.g.,
+                      np.subtract or np.divide.
+        """
+        with profiler.stage('calibrate'):
+            self.__setImage(operation(self.__unscaled, correction))
+
+    def _combine(self, others, images, method):
+        """
+        Name: _combine
+
+        Description:
+        Internal method used when building a master calibration frame.
+        The names and headers of the other instances are appended to
+        this instance, as in __add__, and the image is replaced by the
+        pixel by pixel median or mean of the input images.
+
+        Parameters:
+        others    A list of the other instances which went into the
+                  combined image.
+        images    A list of the 2D numpy arrays to combine, one for this
+                  instance and one for each of the others.
+        method    Either 'median', which rejects cosmic rays, or 'mean'.
+        """
+        with profiler.stage('combine'):
+            if (method == 'median'):
+                image = np.median(images, axis = 0)
+            elif (method == 'mean'):
+                image = np.mean(images, axis = 0)
+            else:
+                raise(ValueError('Unknown combine method "' + method + '"'))
+
+        for other in others:
+            self.name.append(other.name[0])
+            self.__header.append(other.__header[0])
+        self.__setImage(image)
+
+    def _accumulate(self, other, image):
+        """
+        Name: _accumulate
+
+        Description:
+        Internal method used when building a master calibration frame one
+        image at a time, e.g., while observing. The name and header of the
+        other instance are appended to this instance and its image is
+        folded into the running mean, so earlier images never have to be
+        read again.
+
+        Parameters:
+        other    The instance being added to the master.
+        image    The 2D numpy array to fold in, e.g., the image of other
+                 normalized the same way as the master.
+        """
+        with profiler.stage('accumulate'):
+            self.name.append(other.name[0])
+            self.__header.append(other.__header[0])
+            self.__setImage(self.__unscaled + (image - self.__unscaled) / self.numbImagesCombined)
+
+    def __setImage(self, image):
+        """
+        Name: __setImage
+
+        Description:
+        Internal "private" method which replaces the image, and the
+        original unscaled image if it is being kept. A shared instance
+        stops being shared, since the shared file holds the old pixels.
+        """
+        self.unshare()
+        self.__image = image
+        if (self.__original is not None):
+            self.__original = image
+
+    @property
+    def __unscaled(self):
+        #The unscaled image, which is the image itself if the original is not kept
+        return self.__image if self.__original is None else self.__original
+
+    def share(self, directory = None):
+        """
+        Name: share
+
+        Description:
+        Moves the pixel data of this instance into a memory mapped file,
+        by default in /dev/shm where it is held in shared memory. After
+        this, pickling the instance, e.g., to send it to a worker process,
+        only sends the name of the file and the header rather than copying
+        the pixels. The other process maps the file copy-on-write, so any
+        changes it makes stay private. The file is deleted by unshare, or
+        once this instance is deleted, so it has to be kept until the other
+        processes have received it. Calling share again does nothing.
+
+        Parameters:
+        directory    The directory to put the file in. Defaults to /dev/shm
+                     if it exists, otherwise the temporary directory.
+        """
+        if (self.__sharedFile is not None):
+            return
+        if (directory is None):
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+        arrays = self.__pixels()
+        layout = []
+        offset = 0
+        for key, array in arrays.items():
+            if (array is not None):
+                layout.append((key, offset, array.shape, array.dtype.str))
+                offset += -(-array.nbytes // 64)*64    #Keep every array aligned
+
+        handle, path = tempfile.mkstemp(prefix = 'DCTRedux_', suffix = '.dat', dir = directory)
+        os.close(handle)
+        buffer = np.memmap(path, dtype = np.uint8, mode = 'w+', shape = (max(offset, 1),))
+        for key, start, shape, dtype in layout:
+            view = np.ndarray(shape, dtype = dtype, buffer = buffer, offset = start)
+            view[...] = arrays[key]
+            arrays[key] = view
+        self.__setPixels(arrays)
+        self.__sharedFile = (path, layout)
+        weakref.finalize(self, _removeFile, path)
+
+    def unshare(self):
+        """
+        Name: unshare
+
+        Description:
+        Deletes the memory mapped file made by share. The pixels stay
+        mapped, and usable, in every process which already has them, but
+        the instance is pickled with its pixels again from now on. This is
+        done automatically when the image is replaced, e.g. by a calibration.
+        Does nothing if share has not been called.
+        """
+        if (self.__sharedFile is not None):
+            _removeFile(self.__sharedFile[0])
+            self.__sharedFile = None
+
+    def __pixels(self):
+        #The pixel arrays, with the original left out when it is the image itself
+        original = None if self.__original is self.__image else self.__original
+        return {'image': self.__image, 'original': original,
+                'prescan': self.__prescan, 'postscan': self.__postscan}
+
+    def __setPixels(self, arrays):
+        self.__image    = arrays['image']
+        self.__prescan  = arrays['prescan']
+        self.__postscan = arrays['postscan']
+        if (arrays['original'] is not None):
+            self.__original = arrays['original']
+        elif (self.__original is not None):
+            self.__original = self.__image
+
+    def write(self, path, overwrite = False):
+        """
+        Name: write
+
+        Description:
+        Writes the image out to a fits file. The header is that of the
+        first image in this instance, with the PRESCAN and POSTSCAN set
+        to zero since those regions have been removed, and with a HISTORY
+        card for every image which went into this instance.
+
+        Parameters:
+        path         The path of the fits file to write.
+        overwrite    Boolean determining whether an existing file may be
+                     overwritten. Defaults to false.
+        """
+        header = fits.Header(self.__header[0])
+        header['PRESCAN']  = 0
+        header['POSTSCAN'] = 0
+        for key in [key for key in header if re.match('(DATA|BIAS|DET)SEC[0-9]+$', key)]:
+            del header[key]
+        for name in self.name:
+            header['HISTORY'] = 'DCTRedux: ' + name
+        with profiler.stage('write'):
+            data = np.asarray(self.__unscaled, dtype = np.float32)
+            fits.writeto(path, data, header, overwrite = overwrite)
+        profiler.count('framesWritten')
+        profiler.count('bytesWritten', data.nbytes)
+
     def scale(self, scale = 'linear', power = 1.0, min_cut = None, max_cut = None):
         """
         Name: scale
@@ -138,7 +455,8 @@ class DataEnc(metaclass = abc.ABCMeta):
         Description:
         Allows for rescaling the image. This will always scale the original
         image so calling scale a second time on the image will overwrite
-        a previous scaling.
+        a previous scaling. If the original was not kept, the scaling is
+        applied to the image itself and cannot be undone.
 
         Parameters:
         scale
@@ -146,13 +464,54 @@ class DataEnc(metaclass = abc.ABCMeta):
         min_cut
         max_cut
         """
-        self.__image = vis.scale_image(self.__original,
-                                       scale = scale,
-                                       power = power,
-                                       min_cut = min_cut,
-                                       max_cut = max_cut)
+        self.unshare()
+        with profiler.stage('scale'):
+            self.__image = vis.scale_image(self.__unscaled,
+                                           scale = scale,
+                                           power = power,
+                                           min_cut = min_cut,
+                                           max_cut = max_cut)
     
     ### Class Methods ###
+
+    @classmethod
+    def getNumbInstances(cls):
+        """
+        Name: getNumbInstances
+
+        Description:
+        Returns the number of instances of this class which currently
+        exist in this process.
+        """
+        return len(DataEnc.__instances.get(cls, ()))
+
+    @staticmethod
+    def _rebuild(cls, name, headers, amplifiers, pixels, state):
+        """
+        Name: _rebuild
+
+        Description:
+        Internal method which recreates an instance from the pieces given
+        by __reduce__ when it is unpickled.
+        """
+        self = cls.__new__(cls)
+        self.name = name
+        self.__header = headers
+        self.__amplifiers = amplifiers
+        self.__original = None if pixels.pop('keepOriginal') is False else True
+
+        if ('sharedFile' in pixels):
+            path, layout = pixels['sharedFile']
+            buffer = np.memmap(path, dtype = np.uint8, mode = 'c')
+            pixels = {'image': None, 'original': None, 'prescan': None, 'postscan': None}
+            for key, start, shape, dtype in layout:
+                pixels[key] = np.ndarray(shape, dtype = dtype, buffer = buffer, offset = start)
+        self.__setPixels(pixels)
+
+        for key, value in state.items():
+            setattr(self, key, value)
+
+        return self
     
     @classmethod
     def avg(cls, *args):
@@ -187,6 +546,61 @@ class DataEnc(metaclass = abc.ABCMeta):
         return result
     
     ### Magic Methods ###
+
+    def __reduce__(self):
+        """
+        Name: __reduce__
+
+        Description:
+        Describes how to pickle this instance, e.g., to send it to another
+        process. The headers are sent as plain dicts of their keywords,
+        which are much cheaper to pickle than astropy headers, and the
+        original image is only sent if it differs from the image. If share
+        has been called, only the name of the shared file is sent in place
+        of the pixels.
+
+        Returns:
+        The function which rebuilds the instance and its arguments.
+        """
+        headers = [{key: value for key, value in header.items() if key not in ('', 'COMMENT', 'HISTORY')}
+                   for header in self.__header]
+        if (self.__sharedFile is not None):
+            pixels = {'sharedFile': self.__sharedFile}
+        else:
+            pixels = self.__pixels()
+        pixels['keepOriginal'] = self.__original is not None
+
+        #The attributes added by the subclasses
+        state = {}
+        for klass in type(self).__mro__:
+            if (klass is not DataEnc):
+                for slot in getattr(klass, '__slots__', ()):
+                    if (hasattr(self, slot)):
+                        state[slot] = getattr(self, slot)
+
+        return DataEnc._rebuild, (type(self), self.name, headers, self.__amplifiers, pixels, state)
+
+    def __deepcopy__(self, memo):
+        """
+        Name: __deepcopy__
+
+        Description:
+        Copies every attribute of this instance, keeping the full headers.
+        A copy of a shared instance holds its pixels in ordinary memory.
+        """
+        result = type(self).__new__(type(self))
+        memo[id(self)] = result
+        for klass in type(self).__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                if (slot == '__weakref__'):
+                    continue
+                if (slot.startswith('__')):
+                    slot = '_' + klass.__name__ + slot
+                if (hasattr(self, slot)):
+                    setattr(result, slot, copy.deepcopy(getattr(self, slot), memo))
+        result.__sharedFile = None
+
+        return result
     
     def __add__(self, other):
         """
@@ -210,12 +624,14 @@ class DataEnc(metaclass = abc.ABCMeta):
         the same conditions.
         """
         try:
-            result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
+            with profiler.stage('deepcopy'):
+                result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
             result.name.append(other.name[0])
             result.__header.append(other.__header[0])
             result.__prescan  += other.__prescan
             result.__image    += other.__image
-            result.__original += other.__original
+            if (result.__original is not None and result.__original is not result.__image):
+                result.__original += other.__unscaled
             result.__postscan += other.__postscan
             
             return result
@@ -245,12 +661,14 @@ class DataEnc(metaclass = abc.ABCMeta):
         the same conditions.
         """
         try:
-            result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
+            with profiler.stage('deepcopy'):
+                result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
             result.name.append(other.name[0])
             result.__header.append(other.__header[0])
             result.__prescan  /= other.__prescan
             result.__image    /= other.__image
-            result.__original /= other.__original
+            if (result.__original is not None and result.__original is not result.__image):
+                result.__original /= other.__unscaled
             result.__postscan /= other.__postscan
             
             return result
@@ -276,12 +694,14 @@ class DataEnc(metaclass = abc.ABCMeta):
         
         """
         try:
-            result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
+            with profiler.stage('deepcopy'):
+                result = copy.deepcopy(self)    #Create a deep copy so as to not change this instance
             result.name.append(other.name[0])
             result.__header.append(other.__header[0])
             result.__prescan  -= other.__prescan
             result.__image    -= other.__image
-            result.__original -= other.__original
+            if (result.__original is not None and result.__original is not result.__image):
+                result.__original -= other.__unscaled
             result.__postscan -= other.__postscan
             
             return result
@@ -328,6 +748,10 @@ class DataEnc(metaclass = abc.ABCMeta):
         
         raise(IndexError('No header files found'))
     
+    @property
+    def amplifiers(self):
+        return self.__amplifiers
+
     @property
     def date(self):
         if (self.numbImagesCombined == 1):
@@ -379,7 +803,7 @@ class DataEnc(metaclass = abc.ABCMeta):
     
     @property
     def height(self):
-        return self.__header[0]['NAXIS2']
+        return self.__image.shape[0]
     
     @property
     def hourAngle(self):
@@ -443,7 +867,7 @@ class DataEnc(metaclass = abc.ABCMeta):
     
     @property
     def width(self):
-        return self.__header[0]['NAXIS1']-self.__header[0]['PRESCAN']-self.__header[0]['POSTSCAN']
+        return self.__image.shape[1]
 
 
 ###----------------------------------------------
@@ -461,28 +885,58 @@ class DataEnc(metaclass = abc.ABCMeta):
 
 class Bias(DataEnc):
     
-    __numbBias = 0
+    __slots__ = ()
     
     ### Constructor ###
     
-    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True):
-        super().__init__(path, subtractOverscans, removeCosmicRays)
-        Bias.__numbBias += 1
-    
-    ### Destructor ###
-    
-    def __del__(self):
-        Bias.__numbBias -= 1
+    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True, amplifiers = None, keepOriginal = True,
+                 normalizeGain = True):
+        super().__init__(path, subtractOverscans, removeCosmicRays, amplifiers, keepOriginal, normalizeGain)
     
     ### Utility Methods ###
     
+    def accumulate(self, biasFrame):
+        """
+        Method to add a new bias image to this master bias,
+        made with combine, as a running mean.
+        """
+        self._accumulate(biasFrame, biasFrame.image)
     
-    
+    ### Class Methods ###
+
+    @classmethod
+    def combine(cls, *args, method = 'median'):
+        """
+        Name: combine
+
+        Description:
+        Combines a number of bias images into a master bias.
+
+        This is a class method and thus must be called from the class
+        rather than from a specific instance.
+
+        Parameters:
+        *args     The instances of Bias to combine.
+        method    Either 'median' (the default), which rejects cosmic rays,
+                  or 'mean'.
+
+        Returns:
+        A new instance of Bias whose header contains the info of all
+        the biases.
+        """
+        if (len(args) == 0):
+            raise(ValueError('No biases given to combine'))
+
+        master = copy.deepcopy(args[0])
+        master._combine(args[1:], [bias.image for bias in args], method)
+
+        return master
+
     ### Static Methods ###
     
     @staticmethod
     def getNumbBias():
-        return Bias.__numbBias
+        return Bias.getNumbInstances()
     
     ### Property Methods ###
 
@@ -502,20 +956,15 @@ class Bias(DataEnc):
 
 class Flat(DataEnc):
     
-    __numbFlat = 0
+    __slots__ = ('_isBiasCorrected',)
     
     ### Constructor ###
     
-    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True):
-        super().__init__(path, subtractOverscans, removeCosmicRays)
-        Flat.__numbFlat += 1
+    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True, amplifiers = None, keepOriginal = True,
+                 normalizeGain = True):
+        super().__init__(path, subtractOverscans, removeCosmicRays, amplifiers, keepOriginal, normalizeGain)
 
-        self.isBiasCorrected = False
-    
-    ### Destructor ###
-    
-    def __del__(self):
-        Flat.__numbFlat -= 1
+        self._isBiasCorrected = False
     
     ### Utility Methods ###
     
@@ -524,14 +973,59 @@ class Flat(DataEnc):
         Method to subtract the input bias image from
         this instance.
         """
-        self -= biasFrame
+        self._calibrate(biasFrame.image, np.subtract)
         self._isBiasCorrected = True
+
+    def accumulate(self, flatFrame):
+        """
+        Method to add a new flat image, normalized by its
+        median, to this master flat, made with combine, as
+        a running mean.
+        """
+        self._accumulate(flatFrame, flatFrame.image / np.median(flatFrame.image))
+        self._isBiasCorrected = self._isBiasCorrected and flatFrame.isBiasCorrected
     
+    ### Class Methods ###
+
+    @classmethod
+    def combine(cls, *args, method = 'median'):
+        """
+        Name: combine
+
+        Description:
+        Combines a number of flat images into a master flat. Each of
+        the flats is first normalized by its own median so that flats
+        of different brightness can be combined, and the master is
+        normalized to a median of one. The flats should already be bias
+        corrected and all be taken through the same filter.
+
+        This is a class method and thus must be called from the class
+        rather than from a specific instance.
+
+        Parameters:
+        *args     The instances of Flat to combine.
+        method    Either 'median' (the default), which rejects cosmic rays,
+                  or 'mean'.
+
+        Returns:
+        A new instance of Flat whose header contains the info of all
+        the flats.
+        """
+        if (len(args) == 0):
+            raise(ValueError('No flats given to combine'))
+
+        master = copy.deepcopy(args[0])
+        master._combine(args[1:], [flat.image / np.median(flat.image) for flat in args], method)
+        master._calibrate(np.median(master.image), np.divide)
+        master._isBiasCorrected = all(flat.isBiasCorrected for flat in args)
+
+        return master
+
     ### Static Methods ###
     
     @staticmethod
     def getNumbFlat():
-        return Flat.__numbFlat
+        return Flat.getNumbInstances()
     
     ### Property Methods ###
 
@@ -540,6 +1034,157 @@ class Flat(DataEnc):
         return self._isBiasCorrected
     
 
+###----------------------------------------------
+#
+# Name:     Dark
+#
+# Purpose:  This class extends from the DataEnc
+#           class and is meant for specifically
+#           creating Dark images. Since dark current
+#           grows with time, a master dark is kept
+#           as a rate (counts per second) and scaled
+#           to the exposure time of each image it
+#           is used to correct. Scaled masters are
+#           cached per exposure time. This class has
+#           a static member which keeps track of
+#           how many total dark images have been
+#           created.
+#
+###----------------------------------------------
+
+class Dark(DataEnc):
+
+    __slots__ = ('_isBiasCorrected', '_isRate', '_scaledMasters')
+
+    ### Constructor ###
+
+    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True, amplifiers = None, keepOriginal = True,
+                 normalizeGain = True):
+        super().__init__(path, subtractOverscans, removeCosmicRays, amplifiers, keepOriginal, normalizeGain)
+
+        self._isBiasCorrected = False
+        self._isRate = False
+        self._scaledMasters = {}
+
+    ### Utility Methods ###
+
+    def subtractBias(self, biasFrame):
+        """
+        Method to subtract the input bias image from
+        this instance.
+        """
+        self._calibrate(biasFrame.image, np.subtract)
+        self._isBiasCorrected = True
+        self._scaledMasters = {}
+
+    def accumulate(self, darkFrame):
+        """
+        Method to add the rate of a new dark image to this
+        master dark, made with combine, as a running mean.
+        """
+        if (not self._isRate):
+            raise(ValueError('Darks can only be accumulated into a master dark made with combine'))
+        self._accumulate(darkFrame, darkFrame.rate)
+        self._isBiasCorrected = self._isBiasCorrected and darkFrame.isBiasCorrected
+        self._scaledMasters = {}
+
+    def scaledTo(self, expTime):
+        """
+        Name: scaledTo
+
+        Description:
+        Returns the dark current expected in an exposure of the given
+        length, i.e., the dark rate multiplied by the exposure time. The
+        result is cached so that science frames with equal exposure times
+        all share the same scaled master rather than rescaling it for every
+        frame. The returned array is read only.
+
+        Parameters:
+        expTime    The exposure time, in seconds, to scale the dark to.
+
+        Returns:
+        A 2D numpy array of the scaled dark.
+        """
+        expTime = float(expTime)
+        if (expTime not in self._scaledMasters):
+            profiler.count('darkCacheMisses')
+            scaled = self.rate * expTime
+            scaled.setflags(write = False)
+            self._scaledMasters[expTime] = scaled
+        else:
+            profiler.count('darkCacheHits')
+
+        return self._scaledMasters[expTime]
+
+    ### Class Methods ###
+
+    @classmethod
+    def combine(cls, *args, method = 'median'):
+        """
+        Name: combine
+
+        Description:
+        Combines a number of dark images into a master dark. Each of
+        the darks is first converted into a rate by dividing by its own
+        exposure time, so darks of different lengths can be combined
+        together. The darks should already be bias corrected.
+
+        This is a class method and thus must be called from the class
+        rather than from a specific instance.
+
+        Parameters:
+        *args     The instances of Dark to combine.
+        method    Either 'median' (the default), which rejects cosmic rays
+                  and hot transients, or 'mean'.
+
+        Returns:
+        A new instance of Dark whose image is the dark rate in counts
+        per second and whose header contains the info of all the darks.
+        """
+        if (len(args) == 0):
+            raise(ValueError('No darks given to combine'))
+
+        master = copy.deepcopy(args[0])
+        master._combine(args[1:], [dark.rate for dark in args], method)
+        master._isBiasCorrected = all(dark.isBiasCorrected for dark in args)
+        master._isRate = True
+        master._scaledMasters = {}
+
+        return master
+
+    ### Static Methods ###
+
+    @staticmethod
+    def getNumbDark():
+        return Dark.getNumbInstances()
+
+    ### Magic Methods ###
+
+    def __reduce__(self):
+        #The scaled masters are cheap to remake, so they are not pickled
+        rebuild, args = super().__reduce__()
+        args[-1]['_scaledMasters'] = {}
+
+        return rebuild, args
+
+    ### Property Methods ###
+
+    @property
+    def isBiasCorrected(self):
+        return self._isBiasCorrected
+
+    @property
+    def isMaster(self):
+        return self._isRate
+
+    @property
+    def rate(self):
+        if (self._isRate):
+            return self.image
+
+        return self.image / np.sum(self.expTime)
+
+
 ###----------------------------------------------
 #
 # Name:     Image
@@ -557,22 +1202,18 @@ class Flat(DataEnc):
 
 class Image(DataEnc):
     
-    __numbImages = 0
+    __slots__ = ('_isBiasCorrected', '_isDarkCorrected', '_isFlatCorrected')
     
     ### Constructor ###
     
-    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True):
-        super().__init__(path, subtractOverscans, removeCosmicRays)
-        Image.__numbImages += 1
+    def __init__(self, path, subtractOverscans = True, removeCosmicRays = True, amplifiers = None, keepOriginal = True,
+                 normalizeGain = True):
+        super().__init__(path, subtractOverscans, removeCosmicRays, amplifiers, keepOriginal, normalizeGain)
 
         self._isBiasCorrected = False
+        self._isDarkCorrected = False
         self._isFlatCorrected = False
-        
-    
-    ### Destructor ###
-    
-    def __del__(self):
-        Image.__numbImages -= 1
+
     
     ### Utility Methods ###
     
@@ -581,15 +1222,24 @@ class Image(DataEnc):
         Method to subtract the input bias image from
         this instance.
         """
-        self -= biasFrame
+        self._calibrate(biasFrame.image, np.subtract)
         self._isBiasCorrected = True
-    
+
+    def subtractDark(self, darkFrame):
+        """
+        Method to subtract the input dark image, scaled
+        to the exposure time of this instance, from this
+        instance.
+        """
+        self._calibrate(darkFrame.scaledTo(np.sum(self.expTime)), np.subtract)
+        self._isDarkCorrected = True
+
     def divideFlat(self, flatFrame):
         """
         Method to subtract the input flat image from
         this instance.
         """
-        self /= flatFrame
+        self._calibrate(flatFrame.image, np.divide)
         self._isFlatCorrected = True
     
     def findCentroid(self):
@@ -617,7 +1267,7 @@ class Image(DataEnc):
     
     @staticmethod
     def getNumbImagesOpened():
-        return Image.__numbImages
+        return Image.getNumbInstances()
     
     ### Property Methods ###
     
@@ -625,6 +1275,188 @@ class Image(DataEnc):
     def isBiasCorrected(self):
         return self._isBiasCorrected
 
+    @property
+    def isDarkCorrected(self):
+        return self._isDarkCorrected
+
     @property
     def isFlatCorrected(self):
         return self._isFlatCorrected
+
+
+###----------------------------------------------
+#
+# Name:     getAmplifiers
+#
+# Purpose:  These functions describe how the
+#           detector was read out. A frame read
+#           out through several amplifiers has,
+#           for each amplifier n, the header
+#           keywords DATASECn and BIASSECn, and
+#           optionally DETSECn and GAINn, given as
+#           IRAF style sections, e.g. [1:2048,1:4096].
+#           The same information can instead be
+#           given as a table.
+#
+###----------------------------------------------
+
+#The thread pool shared by all images for processing amplifiers concurrently,
+#and the process it was created in
+_amplifierPool = None
+_amplifierPoolPid = None
+
+def _getAmplifierPool():
+    #A forked worker process inherits the pool but not its threads, so
+    #anything submitted to it would never run. A new pool is made instead.
+    global _amplifierPool, _amplifierPoolPid
+    if (_amplifierPool is None or _amplifierPoolPid != os.getpid()):
+        _amplifierPool = concurrent.futures.ThreadPoolExecutor(max_workers = min(8, os.cpu_count() or 1))
+        _amplifierPoolPid = os.getpid()
+
+    return _amplifierPool
+
+def _removeFile(path):
+    #Deletes the memory mapped file of a shared instance once it is no longer needed
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def parseSection(section):
+    """
+    Name: parseSection
+
+    Description:
+    Converts an IRAF style section, '[x1:x2,y1:y2]', with 1 based and
+    inclusive pixel numbers, into numpy slices. A section written from
+    high to low, e.g. [2048:1,1:4096], marks an amplifier read out in
+    the opposite direction.
+
+    Parameters:
+    section    The section as a string.
+
+    Returns:
+    A tuple of the row slice, the column slice, and booleans marking
+    whether the rows and the columns were given from high to low.
+    """
+    match = re.match(r'\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]$', section.strip())
+    if (match is None):
+        raise(ValueError('Could not parse the section "' + section + '"'))
+    x1, x2, y1, y2 = [int(value) for value in match.groups()]
+
+    return (slice(min(y1, y2) - 1, max(y1, y2)), slice(min(x1, x2) - 1, max(x1, x2)), y1 > y2, x1 > x2)
+
+def getAmplifiers(header, table = None):
+    """
+    Name: getAmplifiers
+
+    Description:
+    Finds the amplifier layout of a frame, either from the given table
+    or from the DATASECn, BIASSECn, DETSECn and GAINn header keywords.
+
+    Parameters:
+    header    The fits header of the frame.
+    table     An optional list with a dict for each amplifier with the
+              keys 'DATASEC' and 'BIASSEC', and optionally 'name',
+              'DETSEC' and 'GAIN', e.g.,
+              [{'name': 'left',  'DATASEC': '[33:2080,1:4096]',
+                'BIASSEC': '[1:32,1:4096]', 'GAIN': 2.89}, ...]
+              A missing GAIN is taken from the header GAINn or GAIN
+              keyword, or 1.
+
+    Returns:
+    A list with a dict for each amplifier with the keys 'name', 'DATASEC',
+    'BIASSEC', 'DETSEC' (parsed as by parseSection, DETSEC may be None)
+    and 'GAIN', or None if the frame was read out through a single
+    amplifier described by the PRESCAN and POSTSCAN keywords.
+    """
+    if (table is None):
+        table = []
+        n = 1
+        while ('DATASEC' + str(n) in header):
+            table.append({'name': str(n),
+                          'DATASEC': header['DATASEC' + str(n)],
+                          'BIASSEC': header['BIASSEC' + str(n)],
+                          'DETSEC': header.get('DETSEC' + str(n)),
+                          'GAIN': header.get('GAIN' + str(n))})
+            n += 1
+        if (len(table) == 0):
+            return None
+
+    amps = []
+    for n, entry in enumerate(table):
+        gain = entry.get('GAIN')
+        if (gain is None):
+            gain = header.get('GAIN' + str(n+1), header.get('GAIN', 1.0))
+        amps.append({'name': str(entry.get('name', n+1)),
+                     'DATASEC': parseSection(entry['DATASEC']),
+                     'BIASSEC': parseSection(entry['BIASSEC']),
+                     'DETSEC': parseSection(entry['DETSEC']) if entry.get('DETSEC') is not None else None,
+                     'GAIN': float(gain)})
+
+    return amps
+
+
+###----------------------------------------------
+#
+# Name:     getFiles
+#
+# Purpose:  This function expands the filename
+#           patterns accepted by the GUI and the
+#           batch reduction into a list of fits
+#           files. See DCTReduxGUI.showInputHelp
+#           for the accepted formats.
+#
+###----------------------------------------------
+
+def getFiles(PATH, filenames):
+    """
+    Name: getFiles
+
+    Description:
+    Expands a filename pattern into a list of fits files. The pattern
+    can be a single file, a comma separated list of files, a prefix
+    followed by a list of endings in square brackets, e.g. bias_0[1,2,3],
+    or contain the * wildcard. Extensions are optional.
+
+    Parameters:
+    PATH         The path the filenames are relative to, ending with a
+                 path separator.
+    filenames    The filename pattern.
+
+    Returns:
+    The path the files are in, which can be extended by a path given in
+    a wildcard pattern, and the list of filenames.
+    """
+    if ('.fits' in filenames):
+        filenames = filenames.replace('.fits', '')
+        
+    files = []
+    if ('*' in filenames):
+        if ('\\' in filenames):
+            PATH += filenames[0:filenames.rfind('\\')] + '\\'
+            filenames = filenames[filenames.rfind('\\')+1:]
+        if ('/' in filenames):
+            PATH += filenames[0:filenames.rfind('/')] + '/'
+            filenames = filenames[filenames.rfind('/')+1:]
+        for f in sorted(os.listdir(PATH)):
+            if fnmatch.fnmatch(f, filenames+'.fits'):
+                files.append(f)
+    elif ('[' in filenames and ']' in filenames):
+        prefix, postfix = filenames.split('[')
+        postfix = postfix[:-1].replace(' ','').split(',')
+        files = [prefix + p + '.fits' for p in postfix]
+    elif (',' in filenames):
+        files = filenames.replace(' ','').split(',')
+        files = [file + '.fits' for file in files]
+
+    if (len(files) == 0):
+        files = [filenames + '.fits']
+    
+    return PATH, files
+
+#Running this module directly, e.g. "python -m DCTRedux reduce job.yaml", runs
+#the headless batch reduction. See DCTReduxBatch for the available commands.
+if __name__ == '__main__':
+    from DCTReduxBatch import main
+    sys.exit(main())
@@ -0,0 +1,415 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import sys
+import DCTReduxWatch
+from DCTProfile import profiler
+from DCTRedux import Bias, Dark, Flat, Image, getFiles
+
+###----------------------------------------------
+#
+# Name:     DCTReduxBatch
+#
+# Purpose:  This module is the headless, command
+#           line entry point to the pipeline, for
+#           use on reduction servers or from cron
+#           where the GUI cannot run. A job file
+#           (YAML or JSON) lists the calibration
+#           and science frames using the same
+#           filename patterns as the GUI. Master
+#           calibration frames are built, then the
+#           science frames are calibrated across a
+#           number of worker processes.
+#
+#           Usage:
+#               python -m DCTRedux reduce job.yaml
+#               python DCTReduxBatch.py reduce job.yaml --workers 8
+#
+#           An example job file:
+#               path:    /data/20161020/
+#               output:  /data/20161020/reduced/
+#               bias:    bias_*
+#               dark:    dark_0[1,2,3]
+#               flat:    skyflat_*
+#               images:  object_*
+#               workers: 4
+#
+#           The optional amplifiers setting is a table
+#           of the amplifier sections, for frames whose
+#           headers do not give them, see getAmplifiers.
+#
+#           "python -m DCTRedux watch job.yaml" instead
+#           reduces frames as they are written, see
+#           DCTReduxWatch.
+#
+#           Adding "--profile trace.json" records the
+#           time spent in each stage of the pipeline,
+#           in all the workers, and prints a summary.
+#
+###----------------------------------------------
+
+#Exit codes returned by main
+EXIT_OK              = 0
+EXIT_FRAMES_FAILED   = 1
+EXIT_BAD_JOB         = 2
+EXIT_BAD_CALIBRATION = 3
+
+#Defaults for the optional keys of a job file
+JOB_DEFAULTS = {'dark': None,
+                'flat': None,
+                'workers': 1,
+                'subtractOverscans': True,
+                'removeCosmicRays': True,
+                'combine': 'median',
+                'suffix': '_red',
+                'overwrite': False,
+                'writeMasters': True,
+                'amplifiers': None}
+
+#The master calibration frames used by each worker process, set by _initWorker
+_masters = None
+
+
+### Job Methods ###
+
+def loadJob(path, required = ('path', 'output', 'bias', 'images')):
+    """
+    Name: loadJob
+
+    Description:
+    Reads a job file and fills in the defaults of any optional keys.
+    Files ending in .json are read as JSON, anything else as YAML, which
+    requires the PyYAML package.
+
+    Parameters:
+    path        The path of the job file.
+    required    The keys the job file must have. Defaults to those
+                needed by reduce.
+
+    Returns:
+    A dict of the job settings.
+    """
+    with open(path) as jobFile:
+        if (path.endswith('.json')):
+            job = json.load(jobFile)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise(ValueError('PyYAML is needed to read "' + path + '", use a .json job file instead'))
+            try:
+                job = yaml.safe_load(jobFile)
+            except yaml.YAMLError as error:
+                raise(ValueError(str(error)))
+
+    if (not isinstance(job, dict)):
+        raise(ValueError('The job file "' + path + '" does not define any settings'))
+    missing = [key for key in required if key not in job]
+    if (len(missing) > 0):
+        raise(ValueError('The job file "' + path + '" is missing ' + ', '.join(missing)))
+    unknown = [key for key in job if key not in JOB_DEFAULTS and key not in ('path', 'output', 'bias', 'images')]
+    if (len(unknown) > 0):
+        raise(ValueError('The job file "' + path + '" has unknown settings ' + ', '.join(unknown)))
+
+    for key, value in JOB_DEFAULTS.items():
+        job.setdefault(key, value)
+    for key in ('bias', 'images'):
+        job.setdefault(key, None)
+    for key in ('path', 'output'):
+        if (job[key][-1] != '\\' and job[key][-1] != '/'): job[key] += '/'
+
+    return job
+
+def expandFiles(job, key):
+    """
+    Name: expandFiles
+
+    Description:
+    Expands the filename pattern of the given job key into full paths
+    using getFiles, so all the GUI input formats are accepted.
+
+    Returns:
+    A list of paths, which is empty if the key was not given.
+    """
+    if (job[key] is None):
+        return []
+    path, files = getFiles(job['path'], job[key])
+
+    return [path + file for file in files]
+
+def buildMasters(job):
+    """
+    Name: buildMasters
+
+    Description:
+    Loads and combines the calibration frames of the job into a master
+    bias, an optional master dark and a master flat for every filter.
+    The darks and flats are bias corrected before being combined. If
+    writeMasters is set, the masters are written to the output path.
+
+    Parameters:
+    job    A dict of the job settings, see loadJob.
+
+    Returns:
+    A dict with the keys 'bias', 'dark' (None if no darks were given)
+    and 'flat', a dict of master flats keyed by filter.
+    """
+    options = {'subtractOverscans': job['subtractOverscans'],
+               'removeCosmicRays': job['removeCosmicRays'],
+               'amplifiers': job['amplifiers']}
+
+    biases = [Bias(path, **options) for path in expandFiles(job, 'bias')]
+    masterBias = Bias.combine(*biases, method = job['combine'])
+    print('Combined ' + str(len(biases)) + ' bias images')
+
+    masterDark = None
+    darks = [Dark(path, **options) for path in expandFiles(job, 'dark')]
+    if (len(darks) > 0):
+        for dark in darks:
+            dark.subtractBias(masterBias)
+        masterDark = Dark.combine(*darks, method = job['combine'])
+        print('Combined ' + str(len(darks)) + ' dark images')
+
+    flatsByFilter = {}
+    for path in expandFiles(job, 'flat'):
+        flat = Flat(path, **options)
+        flat.subtractBias(masterBias)
+        flatsByFilter.setdefault(flat.filter, []).append(flat)
+    masterFlats = {}
+    for filter, flats in flatsByFilter.items():
+        masterFlats[filter] = Flat.combine(*flats, method = job['combine'])
+        print('Combined ' + str(len(flats)) + ' flat images in ' + filter)
+
+    if (job['writeMasters']):
+        masterBias.write(job['output'] + 'masterBias.fits', overwrite = job['overwrite'])
+        if (masterDark is not None):
+            masterDark.write(job['output'] + 'masterDark.fits', overwrite = job['overwrite'])
+        for filter, flat in masterFlats.items():
+            flat.write(job['output'] + 'masterFlat_' + filter.replace(' ', '_') + '.fits', overwrite = job['overwrite'])
+
+    return {'bias': masterBias, 'dark': masterDark, 'flat': masterFlats}
+
+def reduceFrame(path, outPath, masters, options):
+    """
+    Name: reduceFrame
+
+    Description:
+    Loads a single science frame, applies the bias, dark and flat
+    corrections in turn, and writes the result.
+
+    Parameters:
+    path       The path of the raw science frame.
+    outPath    The path to write the calibrated frame to.
+    masters    A dict of the master frames, see buildMasters.
+    options    A dict with the subtractOverscans, removeCosmicRays,
+               amplifiers and overwrite settings of the job.
+    """
+    with profiler.stage('reduceFrame'):
+        image = Image(path,
+                      subtractOverscans = options['subtractOverscans'],
+                      removeCosmicRays = options['removeCosmicRays'],
+                      amplifiers = options['amplifiers'],
+                      keepOriginal = False)
+        image.subtractBias(masters['bias'])
+        if (masters['dark'] is not None):
+            image.subtractDark(masters['dark'])
+        if (len(masters['flat']) > 0):
+            if (image.filter not in masters['flat']):
+                raise(KeyError('No master flat for the filter "' + image.filter + '"'))
+            image.divideFlat(masters['flat'][image.filter])
+        image.write(outPath, overwrite = options['overwrite'])
+
+def reduce(job):
+    """
+    Name: reduce
+
+    Description:
+    Runs a full reduction: builds the masters, then calibrates all the
+    science frames, spread across job['workers'] processes. A frame which
+    fails is reported and skipped rather than stopping the whole run.
+
+    Parameters:
+    job    A dict of the job settings, see loadJob.
+
+    Returns:
+    One of the EXIT_ codes of this module.
+    """
+    try:
+        os.makedirs(job['output'], exist_ok = True)
+        with profiler.stage('buildMasters'):
+            masters = buildMasters(job)
+    except Exception as exception:
+        error = type(exception).__name__ + ': ' + str(exception)
+        print('Could not build the master calibration frames: ' + error, file = sys.stderr)
+        return EXIT_BAD_CALIBRATION
+
+    options = {key: job[key] for key in ('subtractOverscans', 'removeCosmicRays', 'amplifiers', 'overwrite')}
+    paths = expandFiles(job, 'images')
+    tasks = [(path, job['output'] + os.path.basename(path)[:-5] + job['suffix'] + '.fits') for path in paths]
+
+    failed = 0
+    if (job['workers'] <= 1):
+        for path, outPath in tasks:
+            failed += _report(path, _reduceTask(path, outPath, masters, options))
+    else:
+        #The masters are sent to each worker once, when it starts, rather
+        #than along with every frame. Sharing them first means only their
+        #headers and the names of their shared memory files are sent.
+        for master in _listMasters(masters):
+            master.share()
+
+        #The shared memory files are removed when done, or if the run is
+        #killed, since they would otherwise stay in memory until a reboot
+        def terminate(signum, frame):
+            _unshareMasters(masters)
+            raise(SystemExit(128 + signum))
+        try:
+            previousHandler = signal.signal(signal.SIGTERM, terminate)
+        except ValueError:
+            #Signal handlers can only be set from the main thread
+            previousHandler = None
+
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = job['workers'],
+                                                      initializer = _initWorker,
+                                                      initargs = (masters, profiler.enabled, profiler.trackMemory))
+        try:
+            futures = {pool.submit(_reduceTask, path, outPath, None, options): path for path, outPath in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                failed += _report(futures[future], future.result())
+        finally:
+            pool.shutdown(cancel_futures = True)
+            _unshareMasters(masters)
+            if (previousHandler is not None):
+                signal.signal(signal.SIGTERM, previousHandler)
+
+    print('Reduced ' + str(len(tasks) - failed) + ' of ' + str(len(tasks)) + ' images')
+
+    return EXIT_OK if failed == 0 else EXIT_FRAMES_FAILED
+
+
+### Worker Methods ###
+
+def _initWorker(masters, profile, trackMemory):
+    global _masters
+    _masters = masters
+
+    #A forked worker starts with a copy of the main process' profiler
+    profiler.reset()
+    if (profile):
+        profiler.enable(trackMemory)
+
+def _reduceTask(path, outPath, masters, options):
+    """
+    Runs reduceFrame, in a worker process if masters is None, and returns
+    None on success or the error message on failure, along with what the
+    profiler recorded in the worker.
+    """
+    error = None
+    try:
+        reduceFrame(path, outPath, _masters if masters is None else masters, options)
+    except Exception as exception:
+        error = type(exception).__name__ + ': ' + str(exception)
+
+    if (masters is None and profiler.enabled):
+        return error, profiler.drain()
+    return error, None
+
+def _listMasters(masters):
+    return [master for master in [masters['bias'], masters['dark']] + list(masters['flat'].values()) if master is not None]
+
+def _unshareMasters(masters):
+    for master in _listMasters(masters):
+        master.unshare()
+
+def _watch(job, args):
+    try:
+        failed = DCTReduxWatch.watch(job, existing = not args.new_only, usePolling = args.poll,
+                                     pollInterval = args.interval, duration = args.duration)
+    except ValueError as error:
+        print('Could not watch: ' + str(error), file = sys.stderr)
+        return EXIT_BAD_JOB
+
+    return EXIT_OK if failed == 0 else EXIT_FRAMES_FAILED
+
+def _report(path, result):
+    error, recorded = result
+    if (recorded is not None):
+        profiler.merge(recorded)
+    if (error is None):
+        print('Reduced ' + path)
+        return 0
+    print('Failed to reduce ' + path + ': ' + error, file = sys.stderr)
+    return 1
+
+
+### Entry Point ###
+
+def main(argv = None):
+    """
+    Name: main
+
+    Description:
+    Parses the command line and runs the requested command.
+
+    Parameters:
+    argv    The list of command line arguments. Defaults to sys.argv.
+
+    Returns:
+    One of the EXIT_ codes of this module, to be passed to sys.exit.
+    """
+    parser = argparse.ArgumentParser(prog = 'DCTRedux', description = 'Headless DCT reduction pipeline')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    reduceCommand = commands.add_parser('reduce', help = 'reduce the frames listed in a job file')
+    reduceCommand.add_argument('job', help = 'the YAML or JSON job file')
+    reduceCommand.add_argument('--workers', type = int, default = None,
+                               help = 'the number of worker processes, overriding the job file')
+    watchCommand = commands.add_parser('watch', help = 'reduce frames as they are written to the job path')
+    watchCommand.add_argument('job', help = 'the YAML or JSON job file')
+    watchCommand.add_argument('--new-only', action = 'store_true',
+                              help = 'skip the frames already in the directory')
+    watchCommand.add_argument('--poll', action = 'store_true',
+                              help = 'poll the directory instead of using inotify')
+    watchCommand.add_argument('--interval', type = float, default = 1.0,
+                              help = 'the seconds between checks for new frames')
+    watchCommand.add_argument('--duration', type = float, default = None,
+                              help = 'stop after this many seconds')
+    for command in (reduceCommand, watchCommand):
+        command.add_argument('--profile', metavar = 'TRACE', default = None,
+                             help = 'time each stage of the pipeline and write a JSON trace')
+        command.add_argument('--profile-memory', action = 'store_true',
+                             help = 'also track the peak memory of each stage, which is slower')
+    args = parser.parse_args(argv)
+
+    try:
+        if (args.command == 'watch'):
+            job = loadJob(args.job, required = ('path', 'output'))
+        else:
+            job = loadJob(args.job)
+    except (OSError, ValueError) as error:
+        print('Could not read the job file: ' + str(error), file = sys.stderr)
+        return EXIT_BAD_JOB
+
+    if (args.command == 'watch'):
+        run = lambda: _watch(job, args)
+    else:
+        if (args.workers is not None):
+            job['workers'] = args.workers
+        run = lambda: reduce(job)
+
+    if (args.profile is None):
+        return run()
+
+    profiler.enable(trackMemory = args.profile_memory)
+    try:
+        status = run()
+    finally:
+        profiler.disable()
+    print('\n' + profiler.table())
+    profiler.writeTrace(args.profile)
+
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
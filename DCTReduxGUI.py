@@ -1,8 +1,9 @@
 import tkinter as tk
 from tkinter import ttk
+from tkinter import filedialog
 from DCTRedux import *
-import os
-import fnmatch
+from DCTProfile import profiler
+from DCTStatistics import statistics
 import pdb
 
 class DCTReduxGUI(object):
@@ -15,6 +16,7 @@ class DCTReduxGUI(object):
         #images that are input through the input tab
         self._bias = []
         self._flat = []
+        self._dark = []
         self._image = []
         self._processedImage = None
 
@@ -29,6 +31,7 @@ class DCTReduxGUI(object):
         self.greetingsTab     = self.__createGreetingsTab()
         self.inputTab         = self.__createInputTab()
         self.analysisTab      = self.__createAnalysisTab()
+        self.profileTab       = self.__createProfileTab()
         
 
         #Set the size of the GUI and begin running it
@@ -135,23 +138,85 @@ class DCTReduxGUI(object):
         self.inputEntryTxt['Flat Filenames'] = tk.StringVar()
         ttk.Entry(inputTab, textvariable = self.inputEntryTxt['Flat Filenames'], width = 50).grid(row = 3, column = 1, columnspan = 2)
 
+        #The input dark filenames label and entry box
+        ttk.Label(inputTab, text = 'Dark Filenames', font = ('Cenutry Gothic', 9)).grid(row = 4, column = 0, stick = 'w', padx = (2,8), pady = 4)
+        self.inputEntryTxt['Dark Filenames'] = tk.StringVar()
+        ttk.Entry(inputTab, textvariable = self.inputEntryTxt['Dark Filenames'], width = 50).grid(row = 4, column = 1, columnspan = 2)
+
         #The input image filenames label and entry box
-        ttk.Label(inputTab, text = 'Image Filenames', font = ('Cenutry Gothic', 9)).grid(row = 4, column = 0, stick = 'w', padx = (2,8), pady = 4)
+        ttk.Label(inputTab, text = 'Image Filenames', font = ('Cenutry Gothic', 9)).grid(row = 5, column = 0, stick = 'w', padx = (2,8), pady = 4)
         self.inputEntryTxt['Image Filenames'] = tk.StringVar()
-        ttk.Entry(inputTab, textvariable = self.inputEntryTxt['Image Filenames'], width = 50).grid(row = 4, column = 1, columnspan = 2)
+        ttk.Entry(inputTab, textvariable = self.inputEntryTxt['Image Filenames'], width = 50).grid(row = 5, column = 1, columnspan = 2)
 
         #The load images button
-        ttk.Button(inputTab, text = 'LOAD IMAGES', command = lambda: self.loadImages()).grid(row = 5, column = 0, columnspan = 3, stick = 'nswe', padx = (2,0), pady = 10)
-        inputTab.rowconfigure(5, minsize = 55)
+        ttk.Button(inputTab, text = 'LOAD IMAGES', command = lambda: self.loadImages()).grid(row = 6, column = 0, columnspan = 3, stick = 'nswe', padx = (2,0), pady = 10)
+        inputTab.rowconfigure(6, minsize = 55)
         
         return inputTab
 
     def __createAnalysisTab(self):
+        """
+        Method for defining the components of the Analysis tab. This shows the
+        statistics and histogram of any of the loaded images, or a region of
+        one, and a table of the statistics of every loaded image.
+        """
+
+        #Define the tab itself and add it to the notebook
         analysisTab = ttk.Frame(self.note)
         self.note.add(analysisTab, text = 'Analysis')
 
+        #The list of loaded images to choose from
+        ttk.Label(analysisTab, text = 'Image', font = ('Cenutry Gothic', 9)).grid(row = 0, column = 0, stick = 'w', padx = (2,8), pady = 4)
+        self.analysisFrame = tk.StringVar()
+        self.analysisFrameBox = ttk.Combobox(analysisTab, textvariable = self.analysisFrame, state = 'readonly', width = 47)
+        self.analysisFrameBox.grid(row = 0, column = 1, columnspan = 4, sticky = 'w')
+
+        #The region to use, left blank for the whole image
+        ttk.Label(analysisTab, text = 'Region (x0, x1, y0, y1)', font = ('Cenutry Gothic', 9)).grid(row = 1, column = 0, stick = 'w', padx = (2,8), pady = 4)
+        self.analysisRegion = []
+        for i in range(4):
+            self.analysisRegion.append(tk.StringVar())
+            ttk.Entry(analysisTab, textvariable = self.analysisRegion[i], width = 10).grid(row = 1, column = i + 1, sticky = 'w')
+
+        #The buttons for finding the statistics
+        ttk.Button(analysisTab, text = 'Statistics', command = lambda: self.showStatistics()).grid(row = 2, column = 0, sticky = 'nswe', padx = 2, pady = 2)
+        ttk.Button(analysisTab, text = 'All Images', command = lambda: self.showAllStatistics()).grid(row = 2, column = 1, columnspan = 2, sticky = 'nswe', padx = 2, pady = 2)
+        ttk.Button(analysisTab, text = 'Histogram', command = lambda: self.showHistogram()).grid(row = 2, column = 3, columnspan = 2, sticky = 'nswe', padx = 2, pady = 2)
+
+        #The text box the statistics are shown in
+        self.analysisText = tk.Text(analysisTab, width = 72, height = 16, font = ('Courier', 9))
+        self.analysisText.grid(row = 3, column = 0, columnspan = 5, padx = 2, pady = 2)
+        self.refreshAnalysisFrames()
+
         return analysisTab
 
+    def __createProfileTab(self):
+        """
+        Method for defining the components of the Profile tab. This lets the
+        profiler be turned on and off and shows a table of the time spent in
+        each stage of the pipeline, which can also be saved as a JSON trace.
+        """
+
+        #Define the tab itself and add it to the notebook
+        profileTab = ttk.Frame(self.note)
+        self.note.add(profileTab, text = 'Profile')
+
+        #The checkbox for enabling the profiler and the buttons for working with it
+        self.profileEnabled = tk.BooleanVar()
+        self.profileEnabled.set(profiler.enabled)
+        ttk.Checkbutton(profileTab, text = 'Enable profiling', variable = self.profileEnabled,
+                        command = lambda: self.toggleProfiler()).grid(row = 0, column = 0, sticky = 'w', padx = (2,0), pady = 2)
+        ttk.Button(profileTab, text = 'Refresh', command = lambda: self.refreshProfile()).grid(row = 0, column = 1, sticky = 'nswe', padx = 2, pady = 2)
+        ttk.Button(profileTab, text = 'Reset', command = lambda: self.resetProfile()).grid(row = 0, column = 2, sticky = 'nswe', padx = 2, pady = 2)
+        ttk.Button(profileTab, text = 'Save Trace', command = lambda: self.saveProfileTrace()).grid(row = 0, column = 3, sticky = 'nswe', padx = 2, pady = 2)
+
+        #The text box the summary table is shown in
+        self.profileText = tk.Text(profileTab, width = 72, height = 16, font = ('Courier', 9))
+        self.profileText.grid(row = 1, column = 0, columnspan = 4, padx = 2, pady = 2)
+        self.refreshProfile()
+
+        return profileTab
+
     
     ### Utility Methods ###
 
@@ -183,57 +248,112 @@ class DCTReduxGUI(object):
         if (PATH[-1] != '\\' and PATH[-1] != '/'): PATH += '/'
         
         #Load in bias images
-        BIAS_PATH, files = self.__getFiles(PATH, self.inputEntryTxt['Bias Filenames'].get())
+        BIAS_PATH, files = getFiles(PATH, self.inputEntryTxt['Bias Filenames'].get())
         for file in files:
             self._bias.append(Bias(BIAS_PATH + file,
-                                   subtractOverscans = self.subtractOverscans.get(),
+                                   subtractOverscans = self.subtractOverscan.get(),
                                    removeCosmicRays = self.removeCosmicRays.get()))
 
         #Load in flat images
-        FLAT_PATH, files = self.__getFiles(PATH, self.inputEntryTxt['Flat Filenames'].get())
+        FLAT_PATH, files = getFiles(PATH, self.inputEntryTxt['Flat Filenames'].get())
         for file in files:
-            self._bias.append(Flat(FLAT_PATH + file,
-                                   subtractOverscans = self.subtractOverscans.get(),
+            self._flat.append(Flat(FLAT_PATH + file,
+                                   subtractOverscans = self.subtractOverscan.get(),
                                    removeCosmicRays = self.removeCosmicRays.get()))
 
+        #Load in dark images, if any were given
+        if (self.inputEntryTxt['Dark Filenames'].get() != ''):
+            DARK_PATH, files = getFiles(PATH, self.inputEntryTxt['Dark Filenames'].get())
+            for file in files:
+                self._dark.append(Dark(DARK_PATH + file,
+                                       subtractOverscans = self.subtractOverscan.get(),
+                                       removeCosmicRays = self.removeCosmicRays.get()))
+
         #Load the the actual images
-        IMAGE_PATH, files = self.__getFiles(PATH, self.inputEntryTxt['Image Filenames'].get())
+        IMAGE_PATH, files = getFiles(PATH, self.inputEntryTxt['Image Filenames'].get())
         for file in files:
-            self._bias.append(Image(IMAGE_PATH + file,
-                                   subtractOverscans = self.subtractOverscans.get(),
-                                   removeCosmicRays = self.removeCosmicRays.get()))
+            self._image.append(Image(IMAGE_PATH + file,
+                                    subtractOverscans = self.subtractOverscan.get(),
+                                    removeCosmicRays = self.removeCosmicRays.get()))
+
+        self.refreshAnalysisFrames()
+
+    def loadedFrames(self):
+        #Every loaded image, keyed by the name shown in the Analysis tab
+        frames = {}
+        for frame in self._bias + self._flat + self._dark + self._image:
+            frames[type(frame).__name__ + ': ' + ', '.join(frame.name)] = frame
+        return frames
+
+    def refreshAnalysisFrames(self):
+        names = list(self.loadedFrames())
+        self.analysisFrameBox['values'] = names
+        if (self.analysisFrame.get() not in names):
+            self.analysisFrame.set(names[0] if len(names) > 0 else '')
+
+    def getAnalysisRegion(self):
+        #The region entered in the Analysis tab, or None if it was left blank
+        values = [entry.get().strip() for entry in self.analysisRegion]
+        if (all(value == '' for value in values)):
+            return None
+        return tuple(int(value) for value in values)
+
+    def showAnalysisText(self, text):
+        self.analysisText.delete('1.0', tk.END)
+        self.analysisText.insert(tk.END, text)
+
+    def showStatistics(self):
+        frame = self.loadedFrames().get(self.analysisFrame.get())
+        if (frame is None):
+            self.showAnalysisText('No images have been loaded')
+            return
+        try:
+            self.showAnalysisText(self.analysisFrame.get() + '\n\n' + str(statistics(frame, self.getAnalysisRegion())))
+        except ValueError as error:
+            self.showAnalysisText('Could not find the statistics: ' + str(error))
+
+    def showAllStatistics(self):
+        try:
+            region = self.getAnalysisRegion()
+            table = '{:<30}{:>10}{:>10}{:>10}{:>10}\n'.format('Image', 'Mean', 'Median', 'Mode', 'MAD')
+            for name, frame in self.loadedFrames().items():
+                stats = statistics(frame, region)
+                table += '{:<30.30}{:>10.5g}{:>10.5g}{:>10.5g}{:>10.4g}\n'.format(name, stats.mean, stats.median, stats.mode, stats.mad)
+            self.showAnalysisText(table)
+        except ValueError as error:
+            self.showAnalysisText('Could not find the statistics: ' + str(error))
+
+    def showHistogram(self):
+        frame = self.loadedFrames().get(self.analysisFrame.get())
+        if (frame is not None):
+            try:
+                statistics(frame, self.getAnalysisRegion()).show()
+            except ValueError as error:
+                self.showAnalysisText('Could not find the statistics: ' + str(error))
+
+    def toggleProfiler(self):
+        if (self.profileEnabled.get()):
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def refreshProfile(self):
+        self.profileText.delete('1.0', tk.END)
+        self.profileText.insert(tk.END, profiler.table())
+
+    def resetProfile(self):
+        profiler.reset()
+        self.refreshProfile()
+
+    def saveProfileTrace(self):
+        path = filedialog.asksaveasfilename(defaultextension = '.json', filetypes = [('JSON trace', '*.json')])
+        if (path):
+            profiler.writeTrace(path)
 
-    def __getFiles(self, PATH, filenames):
-        if ('.fits' in filenames):
-            filenames = filenames.replace('.fits', '')
-            
-        files = []
-        if ('*' in filenames):
-            if ('\\' in filenames):
-                PATH += filenames[0:filenames.rfind('\\')] + '\\'
-                filenames = filenames[filenames.rfind('\\')+1:]
-            if ('/' in filenames):
-                PATH += filenames[0:filenames.rfind('/')] + '/'
-                filenames = filenames[filenames.rfind('/')+1:]
-            for f in os.listdir(PATH):
-                if fnmatch.fnmatch(f, filenames+'.fits'):
-                    files.append(f)
-        elif ('[' in filenames and ']' in filenames):
-            prefix, postfix = filenames.split('[')
-            postfix = postfix[:-1].replace(' ','').split(',')
-            files = [prefix + p + '.fits' for p in postfix]
-        elif (',' in filenames):
-            files = filenames.replace(' ','').split(',')
-            files = [file + '.fits' for file in files]
-
-        if (len(files) == 0):
-            files = [filenames + '.fits']
-        
-        return PATH, files
-    
     def clearLoadedImages(self):
         self._bias = []
         self._flat = []
+        self._dark = []
         self._image = []
         self._processedImage = None
 
@@ -0,0 +1,460 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from astropy.io import fits
+from DCTProfile import profiler
+from DCTRedux import Bias, Dark, Flat, Image
+
+###----------------------------------------------
+#
+# Name:     DCTReduxWatch
+#
+# Purpose:  This module reduces frames during the
+#           night, as they are written. A watcher
+#           reports each new fits file in the raw
+#           data directory, the file is classified
+#           by the OBSTYPE in its header, calibration
+#           frames are folded into running master
+#           frames, and science frames are calibrated
+#           with the current masters straight away.
+#
+#           Usage:
+#               python -m DCTRedux watch job.yaml
+#
+#           The job file is the same as for reduce,
+#           but only path and output are needed.
+#
+###----------------------------------------------
+
+
+###----------------------------------------------
+#
+# Name:     FolderWatcher
+#
+# Purpose:  This class reports new files in a
+#           directory once they have been fully
+#           written. On Linux inotify is used, so
+#           files are reported the moment they are
+#           closed. Elsewhere, or if inotify is not
+#           available, the directory is polled and
+#           a file is reported once its size and
+#           modification time stop changing.
+#
+###----------------------------------------------
+
+class FolderWatcher(object):
+
+    #inotify event flags, from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+
+    ### Constructor ###
+
+    def __init__(self, path, pattern = '.fits', pollInterval = 1.0, usePolling = False):
+        """
+        Starts watching the directory.
+
+        Parameters:
+        path            The directory to watch.
+        pattern         Only files whose names end with this are reported.
+                        Defaults to '.fits'.
+        pollInterval    The time, in seconds, between scans of the directory
+                        when polling. Defaults to 1.
+        usePolling      Boolean which forces polling even if inotify is
+                        available. Defaults to false.
+
+        Properties:
+        mode            Either 'inotify' or 'polling'.
+        """
+        self._path = path
+        self._pattern = pattern
+        self._pollInterval = pollInterval
+        self._fd = None
+        self._buffer = b''
+
+        #The watch is started before the directory is listed, so that a file
+        #written in between is either listed or reported, never missed
+        if (not usePolling):
+            try:
+                self.__startInotify()
+            except (OSError, AttributeError):
+                self._fd = None
+
+        #Files already in the directory are not reported
+        self._seen = set(self.__listFiles())
+        self._sizes = {}
+
+    ### Utility Methods ###
+
+    def __startInotify(self):
+        """
+        Name: __startInotify
+
+        Description:
+        Internal "private" method which sets up an inotify watch through
+        the C library. Raises OSError or AttributeError if inotify is not
+        available, in which case the directory is polled instead.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        fd = libc.inotify_init()
+        if (fd < 0):
+            raise(OSError(ctypes.get_errno(), 'inotify_init failed'))
+        if (libc.inotify_add_watch(fd, os.fsencode(self._path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0):
+            os.close(fd)
+            raise(OSError(ctypes.get_errno(), 'inotify_add_watch failed'))
+        self._fd = fd
+
+    def __listFiles(self):
+        return [name for name in os.listdir(self._path) if name.endswith(self._pattern)]
+
+    def existing(self):
+        """
+        Name: existing
+
+        Description:
+        Returns the paths of the files which were already in the directory
+        when the watcher started, sorted by name.
+        """
+        return [os.path.join(self._path, name) for name in sorted(self._seen)]
+
+    def poll(self, timeout = None):
+        """
+        Name: poll
+
+        Description:
+        Waits for new files to be written.
+
+        Parameters:
+        timeout    The longest time, in seconds, to wait. Defaults to the
+                   poll interval.
+
+        Returns:
+        A list of the paths of the new files, which may be empty.
+        """
+        if (timeout is None):
+            timeout = self._pollInterval
+        if (self._fd is not None):
+            names = self.__readInotify(timeout)
+        else:
+            names = self.__scan(timeout)
+
+        new = []
+        for name in names:
+            if (name not in self._seen):
+                self._seen.add(name)
+                new.append(os.path.join(self._path, name))
+
+        return new
+
+    def __readInotify(self, timeout):
+        """
+        Name: __readInotify
+
+        Description:
+        Internal "private" method which reads the names of files which
+        were closed after writing, or moved in, from the inotify events.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if (len(ready) == 0):
+            return []
+
+        self._buffer += os.read(self._fd, 65536)
+        names = []
+        while (len(self._buffer) >= 16):
+            wd, mask, cookie, length = struct.unpack('iIII', self._buffer[:16])
+            if (len(self._buffer) < 16 + length):
+                break
+            name = os.fsdecode(self._buffer[16:16 + length].rstrip(b'\0'))
+            self._buffer = self._buffer[16 + length:]
+            if (name.endswith(self._pattern)):
+                names.append(name)
+
+        return names
+
+    def __scan(self, timeout):
+        """
+        Name: __scan
+
+        Description:
+        Internal "private" method which scans the directory and returns
+        the names of files whose size and modification time have not
+        changed since the last scan.
+        """
+        time.sleep(timeout)
+        names = []
+        for name in sorted(self.__listFiles()):
+            if (name in self._seen):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._path, name))
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if (stat.st_size > 0 and self._sizes.get(name) == signature):
+                del self._sizes[name]
+                names.append(name)
+            else:
+                self._sizes[name] = signature
+
+        return names
+
+    def close(self):
+        if (self._fd is not None):
+            os.close(self._fd)
+            self._fd = None
+
+    ### Property Methods ###
+
+    @property
+    def mode(self):
+        return 'polling' if self._fd is None else 'inotify'
+
+
+###----------------------------------------------
+#
+# Name:     IncrementalReducer
+#
+# Purpose:  This class keeps running master frames
+#           and reduces frames one at a time as
+#           they arrive. Each bias, dark and flat is
+#           folded into its master as a running mean
+#           so no earlier frame is ever read again.
+#           Science frames are calibrated with the
+#           masters as they stand at that moment.
+#
+###----------------------------------------------
+
+class IncrementalReducer(object):
+
+    ### Constructor ###
+
+    def __init__(self, job):
+        """
+        Sets up the reducer with empty masters.
+
+        Parameters:
+        job    A dict of the job settings, see DCTReduxBatch.loadJob.
+
+        Properties:
+        bias       The current master bias, or None.
+        dark       The current master dark, or None.
+        failed     The number of waiting frames which failed when they
+                   were processed after a bias arrived.
+        flat       A dict of the current master flats, keyed by filter.
+        pending    A list of the paths of frames waiting for a master
+                   bias, darks and flats before science frames.
+        """
+        self._job = job
+        self._options = {'subtractOverscans': job['subtractOverscans'],
+                         'removeCosmicRays': job['removeCosmicRays'],
+                         'amplifiers': job['amplifiers']}
+        self._bias = None
+        self._dark = None
+        self._flat = {}
+        self._pending = []
+        self._pendingCalibration = []
+        self._failed = 0
+
+    ### Utility Methods ###
+
+    def process(self, path):
+        """
+        Name: process
+
+        Description:
+        Classifies a new frame by the OBSTYPE in its header and either adds
+        it to the matching master or calibrates it. Darks, flats and science
+        frames which arrive before any bias are kept until a bias arrives,
+        and are then processed with the darks and flats first. A waiting
+        frame which fails is reported and skipped, without affecting the
+        bias or the other waiting frames.
+
+        Parameters:
+        path    The path of the new fits file.
+
+        Returns:
+        A short description of what was done with the frame.
+        """
+        with profiler.stage('watchFrame'):
+            obsType = str(fits.getheader(path).get('OBSTYPE', '')).lower()
+
+            if (obsType in ('bias', 'zero')):
+                bias = Bias(path, **self._options)
+                if (self._bias is None):
+                    self._bias = Bias.combine(bias, method = 'mean')
+                else:
+                    self._bias.accumulate(bias)
+                self.__writeMaster(self._bias, 'masterBias.fits')
+                done = 'added to the master bias (' + str(self._bias.numbImagesCombined) + ' frames)'
+                if (len(self._pendingCalibration) > 0):
+                    pending, self._pendingCalibration = self._pendingCalibration, []
+                    done += ', added ' + str(self.__replay(pending, self.process)) + ' waiting calibration frames'
+                if (len(self._pending) > 0):
+                    pending, self._pending = self._pending, []
+                    done += ', reduced ' + str(self.__replay(pending, self.__reduce)) + ' waiting frames'
+                return done
+
+            if (obsType == 'dark'):
+                if (self._bias is None):
+                    self._pendingCalibration.append(path)
+                    return 'waiting for a bias'
+                dark = Dark(path, **self._options)
+                dark.subtractBias(self._bias)
+                if (self._dark is None):
+                    self._dark = Dark.combine(dark, method = 'mean')
+                else:
+                    self._dark.accumulate(dark)
+                self.__writeMaster(self._dark, 'masterDark.fits')
+                return 'added to the master dark (' + str(self._dark.numbImagesCombined) + ' frames)'
+
+            if ('flat' in obsType):
+                if (self._bias is None):
+                    self._pendingCalibration.append(path)
+                    return 'waiting for a bias'
+                flat = Flat(path, **self._options)
+                flat.subtractBias(self._bias)
+                if (flat.filter not in self._flat):
+                    self._flat[flat.filter] = Flat.combine(flat, method = 'mean')
+                else:
+                    self._flat[flat.filter].accumulate(flat)
+                master = self._flat[flat.filter]
+                self.__writeMaster(master, 'masterFlat_' + flat.filter.replace(' ', '_') + '.fits')
+                return 'added to the ' + flat.filter + ' master flat (' + str(master.numbImagesCombined) + ' frames)'
+
+            if (obsType == 'object'):
+                if (self._bias is None):
+                    self._pending.append(path)
+                    return 'waiting for a bias'
+                return self.__reduce(path)
+
+            return 'skipped, unknown OBSTYPE "' + obsType + '"'
+
+    def __reduce(self, path):
+        """
+        Name: __reduce
+
+        Description:
+        Internal "private" method which calibrates a science frame with
+        whichever masters exist and writes it out.
+        """
+        image = Image(path, keepOriginal = False, **self._options)
+        image.subtractBias(self._bias)
+        done = ['bias']
+        if (self._dark is not None):
+            image.subtractDark(self._dark)
+            done.append('dark')
+        if (image.filter in self._flat):
+            image.divideFlat(self._flat[image.filter])
+            done.append('flat')
+        outPath = self._job['output'] + os.path.basename(path)[:-5] + self._job['suffix'] + '.fits'
+        image.write(outPath, overwrite = True)
+
+        return 'reduced (' + ', '.join(done) + ')'
+
+    def __replay(self, paths, method):
+        """
+        Name: __replay
+
+        Description:
+        Internal "private" method which processes frames that were waiting
+        for a bias with the given method, reporting and counting any which
+        fail, and returns the number which succeeded.
+        """
+        done = 0
+        for path in paths:
+            try:
+                method(path)
+                done += 1
+            except Exception as error:
+                self._failed += 1
+                _reportFailure(path, error)
+
+        return done
+
+    def __writeMaster(self, master, name):
+        if (self._job['writeMasters']):
+            master.write(self._job['output'] + name, overwrite = True)
+
+    ### Property Methods ###
+
+    @property
+    def bias(self):
+        return self._bias
+
+    @property
+    def dark(self):
+        return self._dark
+
+    @property
+    def failed(self):
+        return self._failed
+
+    @property
+    def flat(self):
+        return self._flat
+
+    @property
+    def pending(self):
+        return self._pendingCalibration + self._pending
+
+
+### Entry Point ###
+
+def watch(job, existing = True, usePolling = False, pollInterval = 1.0, duration = None):
+    """
+    Name: watch
+
+    Description:
+    Watches the raw data directory of the job and reduces every frame
+    as it arrives, until interrupted with Ctrl-C or the duration runs
+    out. A frame which fails is reported and skipped.
+
+    Parameters:
+    job             A dict of the job settings, see DCTReduxBatch.loadJob.
+    existing        Boolean determining whether frames already in the
+                    directory are processed first. Defaults to true.
+    usePolling      Boolean which forces polling instead of inotify.
+    pollInterval    The time, in seconds, between checks for new files.
+    duration        The time, in seconds, to watch for. Defaults to forever.
+
+    Returns:
+    The number of frames which failed, once stopped. Raises ValueError if
+    the output path is the watched directory, since the reduced frames
+    and masters written there would be picked up as new frames.
+    """
+    if (os.path.realpath(job['output']) == os.path.realpath(job['path'])):
+        raise(ValueError('The output path must not be the watched directory "' + job['path'] + '"'))
+    os.makedirs(job['output'], exist_ok = True)
+    watcher = FolderWatcher(job['path'], pollInterval = pollInterval, usePolling = usePolling)
+    reducer = IncrementalReducer(job)
+    print('Watching ' + job['path'] + ' using ' + watcher.mode)
+
+    paths = watcher.existing() if existing else []
+    failed = 0
+    stopAt = None if duration is None else time.time() + duration
+    try:
+        while (stopAt is None or time.time() < stopAt):
+            for path in paths:
+                try:
+                    print(os.path.basename(path) + ': ' + reducer.process(path))
+                except Exception as error:
+                    failed += 1
+                    _reportFailure(path, error)
+                sys.stdout.flush()
+            paths = watcher.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    if (len(reducer.pending) > 0):
+        print(str(len(reducer.pending)) + ' frames were never reduced because no bias arrived', file = sys.stderr)
+
+    return failed + reducer.failed
+
+def _reportFailure(path, error):
+    print('Failed to process ' + path + ': ' + type(error).__name__ + ': ' + str(error), file = sys.stderr)
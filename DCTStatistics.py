@@ -0,0 +1,553 @@
+import weakref
+import numpy as np
+import matplotlib.pyplot as plt
+from DCTProfile import profiler
+
+###----------------------------------------------
+#
+# Name:     DCTStatistics
+#
+# Purpose:  This module finds robust statistics of
+#           images (mean, median, mode, MAD,
+#           percentiles and histograms) without
+#           sorting them. The image is read a block
+#           of rows at a time into a fixed number of
+#           histogram bins, so it works just as well
+#           on memory mapped frames, and results are
+#           cached for every frame and region so
+#           that asking again is instant.
+#
+#           Example:
+#               stats = statistics(image, region = (0, 512, 0, 512))
+#               print(stats.median, stats.mad)
+#               counts, edges = stats.histogram(bins = 100)
+#
+###----------------------------------------------
+
+
+###----------------------------------------------
+#
+# Name:     ImageStatistics
+#
+# Purpose:  This class holds the statistics of an
+#           image, or a region of one. The pixels
+#           are streamed through two histograms
+#           with fixed numbers of bins. The core
+#           histogram has fine bins over the range
+#           of most of the pixels, found from a
+#           sample of rows before streaming. The
+#           outer histogram holds the pixels outside
+#           the core, and its range grows, by
+#           doubling the bin width and merging
+#           neighbouring bins, whenever a pixel
+#           falls outside it. The cumulative
+#           histograms, interpolated within each
+#           bin, are then a sketch of the
+#           distribution from which any quantile
+#           can be read off.
+#
+###----------------------------------------------
+
+class ImageStatistics(object):
+
+    #The number of bins of the outer histogram
+    OUTER_BINS = 4096
+
+    ### Constructor ###
+
+    def __init__(self, image, region = None, bins = 65536, chunkRows = 256):
+        """
+        Finds the statistics of an image in a single pass over its rows.
+
+        The mean and standard deviation are exact. The median, mode, MAD
+        and percentiles come from the histograms and are accurate to within
+        the width of a core bin, given by the resolution property, as long
+        as they fall in the core range. Percentiles far out in the tails,
+        e.g. among cosmic rays, are only as accurate as the outer bins.
+        Pixels which are NaN or infinite are counted but otherwise left out.
+
+        Parameters:
+        image        A DataEnc instance or a 2D numpy array, which may be
+                     memory mapped.
+        region       The region of the image to use, given as (x0, x1, y0, y1)
+                     in pixels with exclusive upper bounds. Defaults to the
+                     whole image.
+        bins         The number of bins of the core histogram. More bins give
+                     finer quantiles at the cost of memory. Defaults to 65536.
+        chunkRows    The number of rows read at a time. Defaults to 256.
+
+        Properties:
+        count         The number of finite pixels.
+        mad           The median absolute deviation from the median.
+        max           The largest finite pixel value.
+        mean          The mean of the finite pixels.
+        median        The median of the finite pixels.
+        min           The smallest finite pixel value.
+        mode          The peak of the histogram, in bins half the MAD wide.
+        nonFinite     The number of NaN or infinite pixels.
+        region        The region used, as (x0, x1, y0, y1).
+        resolution    The width of a core histogram bin.
+        std           The standard deviation of the finite pixels.
+        """
+        if (hasattr(image, 'image')):
+            image = image.image
+        height, width = image.shape
+        if (region is None):
+            region = (0, width, 0, height)
+        x0, x1, y0, y1 = region
+        self._region = region
+
+        self._count = 0
+        self._nonFinite = 0
+        self._below = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+        self._core = None
+        self._outer = None
+
+        with profiler.stage('statistics'):
+            #Place the core histogram using every n-th row, so that only a
+            #few rows are read from disk for a memory mapped frame
+            step = max(1, (y1 - y0)//64)
+            sample = np.asarray(image[y0:y1:step, x0:x1], dtype = np.float64)
+            self.__placeCore(sample[np.isfinite(sample)], bins)
+
+            for start in range(y0, y1, chunkRows):
+                self.__add(np.asarray(image[start:min(start + chunkRows, y1), x0:x1], dtype = np.float64).ravel())
+            profiler.count('statisticsPixels', self._count + self._nonFinite)
+
+        if (self._count == 0):
+            raise(ValueError('There are no finite pixels in the region ' + str(region)))
+
+        self._median = self.percentile(50)
+        self._mad = self.__mad()
+        self._mode = self.__mode()
+
+    ### Utility Methods ###
+
+    def __placeCore(self, sample, bins):
+        """
+        Name: __placeCore
+
+        Description:
+        Internal "private" method which creates the core histogram, spanning
+        three times the 0.1 to 99.9 percentile range of the sample. Does
+        nothing if the sample is empty, in which case it is called again
+        with the first block of pixels.
+        """
+        if (sample.size == 0):
+            self._bins = bins
+            return
+        low, high = np.percentile(sample, [0.1, 99.9])
+        span = high - low
+        if (span == 0):
+            span = max(abs(low), 1.0)*1e-3
+        self._core = _Histogram(low - span, 3*span/bins, bins)
+
+    def __add(self, values):
+        """
+        Name: __add
+
+        Description:
+        Internal "private" method which adds a block of pixels to the
+        running moments and the histograms.
+        """
+        finite = np.isfinite(values)
+        if (not finite.all()):
+            self._nonFinite += values.size - np.count_nonzero(finite)
+            values = values[finite]
+        if (values.size == 0):
+            return
+
+        #Merge the mean and sum of squared deviations of the block with the
+        #running totals, which is stable even for large offsets
+        n = values.size
+        mean = values.mean()
+        m2 = np.sum((values - mean)**2)
+        total = self._count + n
+        delta = mean - self._mean
+        self._mean += delta*n/total
+        self._m2 += m2 + delta**2*self._count*n/total
+        self._count = total
+
+        low, high = values.min(), values.max()
+        self._min = min(self._min, low)
+        self._max = max(self._max, high)
+
+        if (self._core is None):
+            self.__placeCore(values, self._bins)
+        core = self._core
+        if (low >= core.low and high < core.high):
+            core.add(values)
+            return
+
+        #Only the pixels outside the core go in the outer histogram
+        inside = (values >= core.low) & (values < core.high)
+        core.add(values[inside])
+        values = values[~inside]
+        self._below += np.count_nonzero(values < core.low)
+        low, high = values.min(), values.max()
+        if (self._outer is None):
+            span = high - low
+            if (span == 0):
+                span = max(abs(low), 1.0)
+            self._outer = _Histogram(low, span/(self.OUTER_BINS - 1), self.OUTER_BINS)
+        while (low < self._outer.low):
+            self._outer.grow(down = True)
+        while (high >= self._outer.high):
+            self._outer.grow(down = False)
+        self._outer.add(values)
+
+    def __cdf(self, values):
+        """
+        Name: __cdf
+
+        Description:
+        Internal "private" method which returns the number of pixels below
+        each value, from the core histogram inside its range and from the
+        outer histogram, which holds only the pixels outside the core,
+        elsewhere.
+        """
+        values = np.asarray(values, dtype = np.float64)
+        core = self._core
+        if (self._outer is None):
+            return core.cdf(values)
+        outside = self._outer.cdf(values) + np.where(values > core.high, core.total, 0)
+
+        return np.where((values >= core.low) & (values <= core.high), self._below + core.cdf(values), outside)
+
+    def __mad(self):
+        """
+        Name: __mad
+
+        Description:
+        Internal "private" method which finds the distance from the median
+        within which half the pixels lie, by bisection on the cumulative
+        histograms.
+        """
+        low, high = 0.0, max(self._median - self._min, self._max - self._median)
+        half = 0.5*self._count
+        for i in range(64):
+            distance = 0.5*(low + high)
+            if (self.__cdf(self._median + distance) - self.__cdf(self._median - distance) < half):
+                low = distance
+            else:
+                high = distance
+            if (high - low <= 1e-3*self._core.width):
+                break
+
+        return float(0.5*(low + high))
+
+    def __mode(self):
+        """
+        Name: __mode
+
+        Description:
+        Internal "private" method which finds the peak of the histogram
+        within 5 MAD of the median, with bins half the MAD wide, refined by
+        fitting a parabola through the fullest bin and its neighbours. For
+        integer pixel values, e.g. raw ADU, the bins are a whole number of
+        values wide and centered on them, so that no bin holds more values
+        than its neighbours.
+        """
+        if (self._mad == 0):
+            return self._median
+
+        if (self.__isInteger()):
+            width = max(1, int(round(0.5*self._mad)))
+            start = np.floor(self._median) - 10*width - 0.5
+            counts, edges = self.histogram(21, (start, start + 21*width))
+        else:
+            counts, edges = self.histogram(20, (self._median - 5*self._mad, self._median + 5*self._mad))
+        i = int(np.argmax(counts))
+        mode = 0.5*(edges[i] + edges[i + 1])
+        if (0 < i < counts.size - 1):
+            curvature = counts[i - 1] - 2*counts[i] + counts[i + 1]
+            if (curvature < 0):
+                mode += 0.5*(counts[i - 1] - counts[i + 1])/curvature*(edges[1] - edges[0])
+
+        return float(mode)
+
+    def __isInteger(self):
+        """
+        Name: __isInteger
+
+        Description:
+        Internal "private" method which checks whether every pixel in the
+        core histogram is a whole number, i.e., only the bins holding whole
+        numbers are filled. Only possible to tell if the bins are narrower
+        than 1.
+        """
+        core = self._core
+        if (core.width >= 0.5 or core.total == 0 or core.high - core.low > 1e6):
+            return False
+        values = np.arange(np.ceil(core.low), core.high)
+        index = np.clip(((values - core.low)/core.width).astype(np.intp), 0, core.counts.size - 1)
+
+        return int(np.sum(core.counts[index])) == core.total
+
+    def percentile(self, q):
+        """
+        Name: percentile
+
+        Description:
+        Finds one or more percentiles of the pixels.
+
+        Parameters:
+        q    A percentile, or a list of them, between 0 and 100.
+
+        Returns:
+        The value, or a numpy array of values, at the given percentiles.
+        """
+        rank = np.asarray(q, dtype = np.float64)/100*self._count
+        core = self._core
+        values = core.quantile(rank - self._below)
+        if (self._outer is not None):
+            outside = self._outer.quantile(np.where(rank < self._below, rank, rank - core.total))
+            values = np.where((rank >= self._below) & (rank <= self._below + core.total), values, outside)
+        values = np.clip(values, self._min, self._max)
+
+        return float(values) if values.ndim == 0 else values
+
+    def histogram(self, bins = 256, range = None):
+        """
+        Name: histogram
+
+        Description:
+        Rebins the histograms for display.
+
+        Parameters:
+        bins     The number of bins. Defaults to 256.
+        range    A 2-tuple of the lowest and highest values to include.
+                 Defaults to the 0.5 to 99.5 percentile range, which leaves
+                 out hot pixels and cosmic rays.
+
+        Returns:
+        Two numpy arrays, the number of pixels in each bin and the bin
+        edges, as with numpy.histogram.
+        """
+        if (range is None):
+            range = self.percentile([0.5, 99.5])
+        edges = np.linspace(range[0], range[1], bins + 1)
+
+        return np.diff(self.__cdf(edges)), edges
+
+    def show(self, bins = 256, range = None):
+        """
+        Plots the histogram so it can be seen visually, with the median
+        and the median plus and minus the MAD marked.
+
+        Parameters
+        bins     The number of bins. Defaults to 256.
+        range    The range of values to plot. Defaults to the 0.5 to 99.5
+                 percentile range.
+        """
+        counts, edges = self.histogram(bins, range)
+        plt.stairs(counts, edges, fill = True)
+        plt.axvline(self._median, color = 'k')
+        for offset in (-self._mad, self._mad):
+            plt.axvline(self._median + offset, color = 'k', linestyle = '--')
+        plt.xlabel('Pixel Value')
+        plt.ylabel('Number of Pixels')
+        plt.show(block = False)
+
+    ### Magic Methods ###
+
+    def __str__(self):
+        low, high = self.percentile([5, 95])
+        string = 'IMAGE STATISTICS\n' + \
+                 'Region:         ' + str(self.region) + '\n' + \
+                 'Pixels:         ' + str(self.count) + (' (' + str(self.nonFinite) + ' not finite)' if self.nonFinite > 0 else '') + '\n' + \
+                 'Mean:           ' + '{:.6g}'.format(self.mean) + '\n' + \
+                 'Std Dev:        ' + '{:.6g}'.format(self.std) + '\n' + \
+                 'Median:         ' + '{:.6g}'.format(self.median) + '\n' + \
+                 'Mode:           ' + '{:.6g}'.format(self.mode) + '\n' + \
+                 'MAD:            ' + '{:.6g}'.format(self.mad) + '\n' + \
+                 'Min, Max:       ' + '{:.6g}, {:.6g}'.format(self.min, self.max) + '\n' + \
+                 '5%, 95%:        ' + '{:.6g}, {:.6g}'.format(low, high) + '\n' + \
+                 'Resolution:     ' + '{:.3g}'.format(self.resolution) + '\n'
+
+        return string
+
+    def __repr__(self):
+        return self.__str__()
+
+    ### Property Methods ###
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mad(self):
+        return self._mad
+
+    @property
+    def max(self):
+        return float(self._max)
+
+    @property
+    def mean(self):
+        return float(self._mean)
+
+    @property
+    def median(self):
+        return self._median
+
+    @property
+    def min(self):
+        return float(self._min)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def nonFinite(self):
+        return self._nonFinite
+
+    @property
+    def region(self):
+        return self._region
+
+    @property
+    def resolution(self):
+        return self._core.width
+
+    @property
+    def std(self):
+        return float(np.sqrt(self._m2/self._count))
+
+
+###----------------------------------------------
+#
+# Name:     _Histogram
+#
+# Purpose:  A histogram with a fixed number of
+#           equal width bins, used by
+#           ImageStatistics. Values are assumed to
+#           be inside its range when added.
+#
+###----------------------------------------------
+
+class _Histogram(object):
+
+    __slots__ = ('low', 'width', 'counts', '_cumulative')
+
+    def __init__(self, low, width, bins):
+        self.low = low
+        self.width = width
+        self.counts = np.zeros(bins, dtype = np.int64)
+        self._cumulative = None
+
+    def add(self, values):
+        index = ((values - self.low)/self.width).astype(np.intp)
+        np.clip(index, 0, self.counts.size - 1, out = index)
+        self.counts += np.bincount(index, minlength = self.counts.size)
+        self._cumulative = None
+
+    def grow(self, down):
+        #Doubles the range by merging every pair of neighbouring bins into
+        #the half of the histogram on the other side
+        half = self.counts.size//2
+        merged = self.counts.reshape(half, 2).sum(axis = 1)
+        self.counts = np.zeros(self.counts.size, dtype = np.int64)
+        if (down):
+            self.low -= self.width*self.counts.size
+            self.counts[half:] = merged
+        else:
+            self.counts[:half] = merged
+        self.width *= 2
+        self._cumulative = None
+
+    def cdf(self, values):
+        return np.interp(values, self.edges, self.cumulative)
+
+    def quantile(self, rank):
+        return np.interp(rank, self.cumulative, self.edges)
+
+    @property
+    def cumulative(self):
+        if (self._cumulative is None):
+            self._cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        return self._cumulative
+
+    @property
+    def edges(self):
+        return self.low + self.width*np.arange(self.counts.size + 1)
+
+    @property
+    def high(self):
+        return self.low + self.width*self.counts.size
+
+    @property
+    def total(self):
+        return int(self.cumulative[-1])
+
+
+### Cache ###
+
+#The statistics found so far, keyed by the id of the frame. Each entry holds
+#weak references to the frame and to the image array the statistics were
+#found from, so that they are found again if the frame is calibrated, and
+#the entry is dropped when the frame, or a bare array, is deleted.
+_cache = {}
+
+def statistics(frame, region = None, bins = 65536, chunkRows = 256):
+    """
+    Name: statistics
+
+    Description:
+    Returns the statistics of a frame, or a region of it, from the cache
+    if they have been found before. Calibrating or rescaling a frame
+    replaces its image, which is noticed, but changing the pixels of an
+    array in place is not, so clearCache should be called after doing so.
+
+    Parameters:
+    frame        A DataEnc instance or a 2D numpy array.
+    region       The region to use, given as (x0, x1, y0, y1) in pixels with
+                 exclusive upper bounds. Defaults to the whole image.
+    bins         The number of histogram bins. Defaults to 65536.
+    chunkRows    The number of rows read at a time. Defaults to 256.
+
+    Returns:
+    An ImageStatistics instance.
+    """
+    image = frame.image if hasattr(frame, 'image') else frame
+    if (region is not None):
+        region = tuple(int(value) for value in region)
+    key = (region, bins)
+
+    entry = _cache.get(id(frame))
+    if (entry is None or entry[0]() is not frame or entry[1]() is not image):
+        entry = (weakref.ref(frame, lambda ref, frameId = id(frame): _forget(frameId, ref)), weakref.ref(image), {})
+        _cache[id(frame)] = entry
+    elif (key in entry[2]):
+        profiler.count('statisticsCacheHits')
+        return entry[2][key]
+
+    profiler.count('statisticsCacheMisses')
+    stats = ImageStatistics(image, region, bins, chunkRows)
+    entry[2][key] = stats
+
+    return stats
+
+def clearCache(frame = None):
+    """
+    Name: clearCache
+
+    Description:
+    Throws away the cached statistics of a frame, or of every frame.
+    """
+    if (frame is None):
+        _cache.clear()
+    else:
+        _cache.pop(id(frame), None)
+
+def _forget(frameId, ref):
+    #Drops the entry of a deleted frame, unless its id has already been reused
+    entry = _cache.get(frameId)
+    if (entry is not None and entry[0] is ref):
+        del _cache[frameId]